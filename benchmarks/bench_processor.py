@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piexif
+from PIL import Image
+
+from modules.archive import StreamingZipWriter
+from modules.decoder import HEIF_BACKEND, decode
+from modules.encoder import ENCODER_PRESETS, JpegEncoder
+from modules.jpeg_exif import replace_exif_segment
+from modules.processor import HeicProcessor
+
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+
+try:
+    import pyheif
+except ImportError:
+    pyheif = None
+
+RESOLUTIONS = {
+    'vga': (640, 480),
+    '2mp': (1920, 1080),
+    '12mp': (4032, 3024),
+}
+PHASES = ('decode', 'orientation', 'exif_load', 'exif_dump', 'encode', 'exif_rewrite', 'verify', 'zip', 'end_to_end')
+
+
+def make_exif(with_gps):
+    exif_dict = {
+        '0th': {
+            piexif.ImageIFD.Make: b'Apple',
+            piexif.ImageIFD.Model: b'iPhone 12',
+            piexif.ImageIFD.DateTime: b'2023:06:01 08:30:00',
+            piexif.ImageIFD.Orientation: 6,
+        },
+        'Exif': {
+            piexif.ExifIFD.DateTimeOriginal: b'2023:06:01 08:30:00',
+            piexif.ExifIFD.DateTimeDigitized: b'2023:06:01 08:30:00',
+        },
+        'GPS': {},
+        '1st': {},
+        'thumbnail': None,
+    }
+    if with_gps:
+        exif_dict['GPS'] = {
+            piexif.GPSIFD.GPSLatitudeRef: b'N',
+            piexif.GPSIFD.GPSLatitude: ((21, 1), (1, 1), (3000, 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b'E',
+            piexif.GPSIFD.GPSLongitude: ((105, 1), (51, 1), (1200, 100)),
+        }
+    return piexif.dump(exif_dict)
+
+
+def make_image(size):
+    # Gradient + nhiễu để dung lượng nén gần với ảnh chụp thật
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40)
+    return Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def make_fixtures(resolutions, include_heic=True):
+    # Sinh fixture hoàn toàn offline: JPEG/HEIC, có/không EXIF, có/không GPS
+    fixtures = []
+    for res_name in resolutions:
+        image = make_image(RESOLUTIONS[res_name])
+        for exif_variant in ('none', 'exif', 'exif_gps'):
+            save_kwargs = {}
+            if exif_variant != 'none':
+                save_kwargs['exif'] = make_exif(with_gps=exif_variant == 'exif_gps')
+            formats = ['jpeg']
+            if include_heic and pillow_heif is not None and HEIF_BACKEND is not None:
+                formats.append('heic')
+            for fmt in formats:
+                buffer = io.BytesIO()
+                if fmt == 'heic':
+                    pillow_heif.from_pillow(image).save(buffer, quality=90, **save_kwargs)
+                else:
+                    image.save(buffer, format='JPEG', quality=92, **save_kwargs)
+                fixtures.append({
+                    'name': f"{res_name}-{exif_variant}.{'heic' if fmt == 'heic' else 'jpg'}",
+                    'format': fmt,
+                    'data': buffer.getvalue(),
+                })
+    return fixtures
+
+
+def time_phases(processor, fixture, zip_writer, encoders=(), sizes=None):
+    # Đo riêng từng bước xử lý cho một ảnh, trả về {phase: giây};
+    # sizes nhận dung lượng output của từng preset encoder
+    timings = {}
+    data = fixture['data']
+
+    start = time.perf_counter()
+    image, raw_exif = decode(data, fixture['format'] == 'heic', use_cache=False)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exif_dict = piexif.load(raw_exif) if raw_exif else {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+    timings['exif_load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = processor.rotate_image(image, exif_dict['0th'].get(piexif.ImageIFD.Orientation))
+    timings['orientation'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processor.update_exif(exif_dict, new_device='iPhone 15 Pro', new_date=datetime.date(2024, 1, 2))
+    exif_bytes = piexif.dump(exif_dict)
+    timings['exif_dump'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif_bytes, quality=95)
+    output_data = buffer.getvalue()
+    timings['encode'] = time.perf_counter() - start
+
+    for encoder in encoders:
+        start = time.perf_counter()
+        encoded = encoder.encode(image, exif_bytes)
+        timings[f'encode_{encoder.preset}'] = time.perf_counter() - start
+        if sizes is not None:
+            sizes[encoder.preset] = len(encoded)
+
+    if fixture['format'] == 'jpeg':
+        start = time.perf_counter()
+        replace_exif_segment(data, exif_bytes)
+        timings['exif_rewrite'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processor.verify_output(output_data, exif_bytes, fixture['name'])
+    timings['verify'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    zip_writer.add(fixture['name'], output_data)
+    timings['zip'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processor.modify_image_bytes(data, fixture['name'], new_device='iPhone 15 Pro', new_date=datetime.date(2024, 1, 2))
+    timings['end_to_end'] = time.perf_counter() - start
+    return timings
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return round(usage / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_benchmark(resolutions, iterations, include_heic=True, presets=()):
+    processor = HeicProcessor()
+    encoders = [JpegEncoder(preset) for preset in presets]
+    fixtures = make_fixtures(resolutions, include_heic=include_heic)
+    results = {}
+    with StreamingZipWriter() as zip_writer:
+        for fixture in fixtures:
+            samples = {phase: [] for phase in PHASES}
+            samples.update({f'encode_{encoder.preset}': [] for encoder in encoders})
+            sizes = {}
+            for _ in range(iterations):
+                for phase, seconds in time_phases(processor, fixture, zip_writer, encoders, sizes).items():
+                    samples[phase].append(seconds)
+            phases = {}
+            for phase, values in samples.items():
+                if not values:
+                    continue
+                mean = statistics.mean(values)
+                phases[phase] = {
+                    'p50_ms': round(percentile(values, 50) * 1000, 3),
+                    'p95_ms': round(percentile(values, 95) * 1000, 3),
+                    'mean_ms': round(mean * 1000, 3),
+                    'images_per_s': round(1 / mean, 2) if mean else None,
+                    'mb_per_s': round(len(fixture['data']) / mean / 1e6, 2) if mean else None,
+                }
+            results[fixture['name']] = {'bytes': len(fixture['data']), 'encoded_bytes': sizes, 'phases': phases}
+        zip_writer.close().close()
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pillow': Image.__version__,
+            'pyheif': getattr(pyheif, '__version__', None),
+            'pillow_heif': getattr(pillow_heif, '__version__', None),
+            'heif_backend': HEIF_BACKEND,
+            'iterations': iterations,
+            'encoders': {encoder.preset: encoder.select_backend(Image.new('RGB', (1, 1))) for encoder in encoders},
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    # So p50 từng phase với baseline; chậm hơn quá tolerance thì coi là regression
+    regressions = []
+    for name, entry in current['results'].items():
+        base_entry = baseline.get('results', {}).get(name)
+        if not base_entry:
+            continue
+        for phase, stats in entry['phases'].items():
+            base_stats = base_entry['phases'].get(phase)
+            if not base_stats or not base_stats['p50_ms']:
+                continue
+            ratio = stats['p50_ms'] / base_stats['p50_ms']
+            stats['baseline_p50_ms'] = base_stats['p50_ms']
+            stats['ratio'] = round(ratio, 3)
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} {phase}: {base_stats['p50_ms']}ms -> {stats['p50_ms']}ms (x{ratio:.2f})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image metadata processing hot paths")
+    parser.add_argument('--resolutions', default='vga,2mp,12mp',
+                        help=f"comma separated subset of {','.join(RESOLUTIONS)}")
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--no-heic', action='store_true', help="only benchmark JPEG fixtures")
+    parser.add_argument('--presets', default=','.join(ENCODER_PRESETS),
+                        help="comma separated encoder presets to time as encode_<preset> (empty to skip)")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('--baseline', help="compare against a previously saved JSON report")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="allowed p50 slowdown vs. the baseline before failing (default 0.10)")
+    args = parser.parse_args(argv)
+
+    # Chuyển mọi output lẻ sang stderr để JSON report không bị lẫn
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(
+            [r for r in args.resolutions.split(',') if r],
+            args.iterations,
+            include_heic=not args.no_heic,
+            presets=[p for p in args.presets.split(',') if p],
+        )
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
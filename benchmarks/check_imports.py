@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Ngân sách thời gian import của từng entry point (ms, median của các lần chạy)
+TARGETS = {
+    'modules': 25,
+    'modules.processor': 150,
+    'modules.gps': 75,
+    'cli': 150,
+}
+# Module không được xuất hiện trong sys.modules sau khi import các entry point trên
+FORBIDDEN = ('streamlit', 'streamlit_authenticator', 'geopy', 'pyheif', 'pillow_heif', 'numpy', 'simplejpeg')
+
+# Chạy trong process con mới để sys.modules và cache import luôn sạch
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {target}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'ms': elapsed * 1000, 'modules': sorted(name for name in sys.modules if '.' not in name)}}))
+"""
+
+
+def measure(target, runs):
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(target=target)],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout
+        sample = json.loads(output)
+        timings.append(sample['ms'])
+        loaded = sample['modules']
+    return {
+        'median_ms': round(statistics.median(timings), 1),
+        'max_ms': round(max(timings), 1),
+        'forbidden': [name for name in FORBIDDEN if name in loaded],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that core modules import quickly and without UI/heavy deps")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply every time budget (slow CI machines)")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {}
+    failures = []
+    for target, budget_ms in TARGETS.items():
+        result = measure(target, args.runs)
+        result['budget_ms'] = budget_ms * args.scale
+        report[target] = result
+        if result['forbidden']:
+            failures.append(f"{target} imports {', '.join(result['forbidden'])}")
+        if result['median_ms'] > result['budget_ms']:
+            failures.append(f"{target} took {result['median_ms']}ms (budget {result['budget_ms']}ms)")
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
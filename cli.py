@@ -0,0 +1,126 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from modules.metrics import REGISTRY, summarize_timings
+from modules.processor import default_output_path, process_images_in_folder_or_file, summarize_scan
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%Y:%m:%d')
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"invalid date {value!r}, expected YYYY-MM-DD or DD/MM/YYYY")
+
+
+def summarize_results(results):
+    summary = {
+        'total': len(results),
+        'succeeded': sum(1 for r in results if r['success'] and not r.get('skipped')),
+        'skipped': sum(1 for r in results if r.get('skipped')),
+        'rejected': {},
+        'failed': sum(1 for r in results if not r['success'] and not r['rejected']),
+    }
+    for r in results:
+        if r['rejected']:
+            summary['rejected'][r['rejected']] = summary['rejected'].get(r['rejected'], 0) + 1
+    return summary
+
+
+def print_progress(done, total, result):
+    if result['rejected']:
+        status = f"rejected ({result['rejected']})"
+    elif result['success']:
+        status = "ok"
+    else:
+        status = f"failed: {result['error']}" if result['error'] else "failed"
+    print(f"[{done}/{total}] {result['file']}: {status}", file=sys.stderr, flush=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Change device and date metadata of JPG/HEIC images")
+    parser.add_argument('input', help="image file or folder")
+    parser.add_argument('-o', '--output', help="output folder (default: <input>_output, recreated on each run)")
+    parser.add_argument('--device', help="new camera model, e.g. 'iPhone 15 Pro'")
+    parser.add_argument('--date', type=parse_date, help="new capture date (YYYY-MM-DD), time of day is kept")
+    parser.add_argument('-j', '--workers', type=int, help="worker processes (default: number of CPUs)")
+    parser.add_argument('-r', '--recursive', action=argparse.BooleanOptionalAction, default=None,
+                        help="also process sub folders (default: only for --dry-run)")
+    parser.add_argument('--resume', action='store_true',
+                        help="keep the output folder and skip images unchanged since the last run (manifest.jsonl)")
+    parser.add_argument('--keep-heic', action='store_true',
+                        help="write HEIC files as HEIC, only rewriting their EXIF (no re-encode)")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be done, write nothing")
+    parser.add_argument('--json', metavar='PATH', help="write a JSON summary to PATH ('-' for stdout)")
+    parser.add_argument('--metrics', metavar='PATH', help="write Prometheus text metrics to PATH")
+    parser.add_argument('-q', '--quiet', action='store_true', help="no per-image progress")
+    parser.add_argument('-v', '--verbose', action='store_true', help="debug logging")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if not os.path.exists(args.input):
+        print(f"{args.input} does not exist", file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    outcome = process_images_in_folder_or_file(
+        args.input,
+        new_device=args.device,
+        new_date=args.date,
+        workers=args.workers,
+        recursive=args.recursive,
+        dry_run=args.dry_run,
+        incremental=args.resume,
+        output_path=args.output,
+        output_format='heic' if args.keep_heic else None,
+        progress=None if args.quiet else print_progress,
+    )
+
+    if args.dry_run:
+        summary = {'input': args.input, 'dry_run': True, 'scan': summarize_scan(outcome), 'files': outcome}
+        failed = summary['scan']['errors']
+    else:
+        # Một file: hàm trả về dict kết quả của file đó
+        results = outcome if isinstance(outcome, list) else [outcome]
+        summary = {
+            'input': args.input,
+            'output': args.output or default_output_path(args.input),
+            'device': args.device,
+            'date': str(args.date) if args.date else None,
+            **summarize_results(results),
+            'elapsed_seconds': round(time.perf_counter() - start, 3),
+            'phases': summarize_timings(r.get('timings') or {} for r in results),
+            'files': [{key: r.get(key) for key in ('file', 'output', 'success', 'skipped', 'rejected', 'error')}
+                      for r in results],
+        }
+        failed = summary['failed']
+
+    if args.json:
+        output = json.dumps(summary, indent=2, ensure_ascii=False, default=str)
+        if args.json == '-':
+            print(output)
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                f.write(output + "\n")
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(REGISTRY.to_prometheus())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
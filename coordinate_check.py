@@ -1,10 +1,10 @@
+import csv
+import io
 import streamlit as st
-import time
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
-from geopy.geocoders import Nominatim
-import pillow_heif
-from io import BytesIO
+import piexif
+from modules.decoder import decode, is_heic_file
+from modules.geocache import CachedGeocoder
+from modules.gps import cluster_coordinates, extract_gps_batch, gps_from_exif, read_raw_exif
 
 st.set_page_config(
     page_title="Image Location Finder",
@@ -12,75 +12,48 @@ st.set_page_config(
     layout="wide"
 )
 
-def get_decimal_from_dms(dms, ref):
-    degrees = dms[0]
-    minutes = dms[1] / 60.0
-    seconds = dms[2] / 3600.0
-    
-    if ref in ['S', 'W']:
-        degrees = -degrees
-        minutes = -minutes 
-        seconds = -seconds
-        
-    return degrees + minutes + seconds
-
-def convert_heic_to_jpg(heic_data):
+# 3 chữ số thập phân ~ 110m: ảnh chụp cùng một chỗ chỉ geocode một lần
+CLUSTER_PRECISION = 3
+REPORT_COLUMNS = ['file', 'latitude', 'longitude', 'datetime', 'state', 'city', 'suburb', 'address', 'error']
+
+def get_preview(data, filename, raw_exif):
+    # JPEG: hiển thị thẳng bytes gốc; HEIC: dùng thumbnail có sẵn trong EXIF,
+    # chỉ decode ảnh khi file không có thumbnail
+    if not is_heic_file(filename):
+        return data
+    if raw_exif:
+        thumbnail = piexif.load(raw_exif).get('thumbnail')
+        if thumbnail:
+            return thumbnail
     try:
-        # Đọc file HEIC
-        heif_file = pillow_heif.read_heif(heic_data)
-        # Chuyển đổi sang PIL Image
-        image = Image.frombytes(
-            heif_file.mode,
-            heif_file.size,
-            heif_file.data,
-            "raw",
-        )
-        # Chuyển đổi sang JPG
-        jpg_data = BytesIO()
-        image.save(jpg_data, format='JPEG')
-        return Image.open(jpg_data)
+        image, _ = decode(data, is_heic=True)
+        return image
     except Exception as e:
-        st.error(f"Lỗi khi chuyển đổi HEIC sang JPG: {str(e)}")
+        st.error(f"Lỗi khi đọc ảnh: {str(e)}")
         return None
 
-def get_gps_data(image):
+def get_gps_data(raw_exif):
+    # Chỉ parse block EXIF/TIFF, không decode pixel
     try:
-        exif = image._getexif()
-        
-        if not exif:
-            return None, None
-
-        gps_info = {}
-        
-        for tag_id in exif:
-            tag = TAGS.get(tag_id, tag_id)
-            data = exif.get(tag_id)
-            
-            if tag == 'GPSInfo':
-                for t in data:
-                    sub_tag = GPSTAGS.get(t, t)
-                    gps_info[sub_tag] = data[t]
-
-        if not gps_info:
-            return None, None
-
-        lat = get_decimal_from_dms(gps_info['GPSLatitude'], gps_info['GPSLatitudeRef'])
-        lon = get_decimal_from_dms(gps_info['GPSLongitude'], gps_info['GPSLongitudeRef'])
-        
-        return lat, lon
-        
+        gps = gps_from_exif(raw_exif)
+        if gps:
+            return gps['latitude'], gps['longitude']
     except Exception as e:
         st.error(f"Lỗi khi đọc GPS: {str(e)}")
-        return None, None
+    return None, None
+
+@st.cache_resource
+def get_geocoder():
+    # Cache dùng chung, chỉ chờ giãn cách 1 giây khi thực sự phải gọi Nominatim
+    from geopy.geocoders import Nominatim
+
+    return CachedGeocoder(Nominatim(user_agent="my_app"))
 
 def get_location_info(latitude, longitude):
     try:
-        geolocator = Nominatim(user_agent="my_app")
-        time.sleep(1)
-        
-        location = geolocator.reverse(f"{latitude}, {longitude}", language='vi')
-        if location and location.raw.get('address'):
-            address = location.raw['address']
+        location = get_geocoder().reverse(latitude, longitude, language='vi')
+        if location and location['raw']:
+            address = location['raw']
             
             state = address.get('state', '')
             city = address.get('city', '')
@@ -90,7 +63,7 @@ def get_location_info(latitude, longitude):
                 'state': state,
                 'city': city,
                 'suburb': suburb,
-                'full_address': location.address
+                'full_address': location['address']
             }
             return location_info
             
@@ -98,82 +71,149 @@ def get_location_info(latitude, longitude):
         st.error(f"Lỗi khi lấy thông tin địa điểm: {str(e)}")
     return None
 
-def main():
-    st.title("🌍 Xác định vị trí từ ảnh")
-    st.write("Upload ảnh để xác định vị trí chụp (Hỗ trợ: JPG, JPEG, HEIC)")
+def show_location(uploaded_file):
+    try:
+        # Hiển thị thanh tiến trình
+        progress_bar = st.progress(0)
+        status_text = st.empty()
 
-    uploaded_file = st.file_uploader("Chọn ảnh", type=['jpg', 'jpeg', 'heic'])
+        # Đọc và xử lý ảnh
+        status_text.text("Đang đọc ảnh...")
+        progress_bar.progress(20)
 
-    if uploaded_file is not None:
-        try:
-            # Hiển thị thanh tiến trình
-            progress_bar = st.progress(0)
-            status_text = st.empty()
+        data = uploaded_file.getvalue()
+        raw_exif = read_raw_exif(data, uploaded_file.name)
 
-            # Đọc và xử lý ảnh
-            status_text.text("Đang đọc ảnh...")
-            progress_bar.progress(20)
+        # Hiển thị ảnh
+        preview = get_preview(data, uploaded_file.name, raw_exif)
+        if preview is not None:
+            st.image(preview, caption="Ảnh đã upload", use_column_width=True)
 
-            if uploaded_file.name.lower().endswith('.heic'):
-                image = convert_heic_to_jpg(uploaded_file.read())
-            else:
-                image = Image.open(uploaded_file)
+        progress_bar.progress(40)
+        status_text.text("Đang trích xuất thông tin GPS...")
 
-            # Hiển thị ảnh
-            st.image(image, caption="Ảnh đã upload", use_column_width=True)
-            
-            progress_bar.progress(40)
-            status_text.text("Đang trích xuất thông tin GPS...")
+        # Lấy tọa độ GPS
+        latitude, longitude = get_gps_data(raw_exif)
 
-            # Lấy tọa độ GPS
-            latitude, longitude = get_gps_data(image)
-            
-            progress_bar.progress(60)
-            
-            if latitude is None or longitude is None:
-                st.warning("Không tìm thấy thông tin GPS trong ảnh.")
-                return
+        progress_bar.progress(60)
 
-            status_text.text("Đang lấy thông tin địa điểm...")
-            progress_bar.progress(80)
+        if latitude is None or longitude is None:
+            st.warning("Không tìm thấy thông tin GPS trong ảnh.")
+            return
 
-            # Lấy thông tin địa điểm
-            location_info = get_location_info(latitude, longitude)
-            
-            progress_bar.progress(100)
-            status_text.text("Hoàn thành!")
-
-            if location_info:
-                # Hiển thị kết quả trong các columns
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    st.subheader("Thông tin GPS")
-                    st.write(f"📍 Vĩ độ: {latitude}")
-                    st.write(f"📍 Kinh độ: {longitude}")
-
-                with col2:
-                    st.subheader("Thông tin địa điểm")
-                    st.write(f"🏛️ Tỉnh/Thành phố: {location_info['state']}")
-                    st.write(f"🏢 Quận/Huyện: {location_info['city']}")
-                    st.write(f"🏠 Phường/Xã: {location_info['suburb']}")
-                
-                st.subheader("Địa chỉ đầy đủ")
-                st.info(location_info['full_address'])
-
-                # Hiển thị bản đồ
-                map_data = f'''
-                    <iframe width="100%" height="450" style="border:0" loading="lazy" allowfullscreen
-                    src="https://www.openstreetmap.org/export/embed.html?bbox={longitude-0.01}%2C{latitude-0.01}%2C{longitude+0.01}%2C{latitude+0.01}&amp;layer=mapnik&amp;marker={latitude}%2C{longitude}">
-                    </iframe>
-                '''
-                st.components.v1.html(map_data, height=450)
-
-            else:
-                st.error("Không thể xác định được địa điểm.")
-
-        except Exception as e:
-            st.error(f"Có lỗi xảy ra: {str(e)}")
+        status_text.text("Đang lấy thông tin địa điểm...")
+        progress_bar.progress(80)
+
+        # Lấy thông tin địa điểm
+        location_info = get_location_info(latitude, longitude)
+
+        progress_bar.progress(100)
+        status_text.text("Hoàn thành!")
+
+        if location_info:
+            # Hiển thị kết quả trong các columns
+            col1, col2 = st.columns(2)
+
+            with col1:
+                st.subheader("Thông tin GPS")
+                st.write(f"📍 Vĩ độ: {latitude}")
+                st.write(f"📍 Kinh độ: {longitude}")
+
+            with col2:
+                st.subheader("Thông tin địa điểm")
+                st.write(f"🏛️ Tỉnh/Thành phố: {location_info['state']}")
+                st.write(f"🏢 Quận/Huyện: {location_info['city']}")
+                st.write(f"🏠 Phường/Xã: {location_info['suburb']}")
+
+            st.subheader("Địa chỉ đầy đủ")
+            st.info(location_info['full_address'])
+
+            # Hiển thị bản đồ
+            map_data = f'''
+                <iframe width="100%" height="450" style="border:0" loading="lazy" allowfullscreen
+                src="https://www.openstreetmap.org/export/embed.html?bbox={longitude-0.01}%2C{latitude-0.01}%2C{longitude+0.01}%2C{latitude+0.01}&amp;layer=mapnik&amp;marker={latitude}%2C{longitude}">
+                </iframe>
+            '''
+            st.components.v1.html(map_data, height=450)
+
+        else:
+            st.error("Không thể xác định được địa điểm.")
+
+    except Exception as e:
+        st.error(f"Có lỗi xảy ra: {str(e)}")
+
+def build_location_report(uploaded_files, workers=8, precision=CLUSTER_PRECISION, progress=None):
+    # Đọc GPS song song chỉ từ EXIF, gom các điểm gần nhau thành cụm và chỉ
+    # geocode một lần cho mỗi cụm (Nominatim giới hạn 1 request/giây)
+    rows = extract_gps_batch(uploaded_files, workers=workers)
+    clusters = cluster_coordinates(rows, precision=precision)
+    for idx, ((latitude, longitude), members) in enumerate(clusters.items()):
+        location_info = get_location_info(latitude, longitude) or {}
+        for row_idx in members:
+            rows[row_idx].update({
+                'state': location_info.get('state'),
+                'city': location_info.get('city'),
+                'suburb': location_info.get('suburb'),
+                'address': location_info.get('full_address'),
+            })
+        if progress:
+            progress(idx + 1, len(clusters))
+    return rows, clusters
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8-sig')
+
+def show_batch_report(uploaded_files):
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    status_text.text(f"Đang đọc GPS của {len(uploaded_files)} ảnh...")
+
+    def progress(done, total):
+        progress_bar.progress(done / total)
+        status_text.text(f"Đang lấy thông tin địa điểm ({done}/{total} cụm)...")
+
+    rows, clusters = build_location_report(uploaded_files, progress=progress)
+    progress_bar.progress(100)
+    located = [row for row in rows if row['latitude'] is not None]
+    status_text.text(
+        f"Hoàn thành! {len(located)}/{len(rows)} ảnh có GPS, {len(clusters)} địa điểm khác nhau."
+    )
+
+    for row in rows:
+        if row['error']:
+            st.error(f"Lỗi khi đọc GPS của {row['file']}: {row['error']}")
+
+    if located:
+        st.map({
+            'lat': [row['latitude'] for row in located],
+            'lon': [row['longitude'] for row in located],
+        })
+    else:
+        st.warning("Không tìm thấy thông tin GPS trong các ảnh.")
+
+    st.dataframe([{column: row.get(column) for column in REPORT_COLUMNS} for row in rows],
+                 use_container_width=True)
+    st.download_button(
+        label="Tải báo cáo (CSV)",
+        data=rows_to_csv(rows),
+        file_name="locations.csv",
+        mime="text/csv",
+    )
+
+def main():
+    st.title("🌍 Xác định vị trí từ ảnh")
+    st.write("Upload ảnh để xác định vị trí chụp (Hỗ trợ: JPG, JPEG, HEIC)")
+
+    uploaded_files = st.file_uploader("Chọn ảnh", type=['jpg', 'jpeg', 'heic'], accept_multiple_files=True)
+
+    if len(uploaded_files) == 1:
+        show_location(uploaded_files[0])
+    elif uploaded_files:
+        show_batch_report(uploaded_files)
     st.markdown("---")
     st.markdown(
         """
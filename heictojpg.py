@@ -1,13 +1,20 @@
-import pyheif
-from PIL import Image
 import piexif
 from geopy.geocoders import Nominatim
 from datetime import datetime
 from unidecode import unidecode
+from modules.decoder import decode, probe
+from modules.encoder import JpegEncoder
+from modules.geocoding import GeocodeQueue, GeolocatorBackend
+from modules.heif_exif import read_heif_exif_from_file
 
 class HeicProcessor:
-    def __init__(self, user_agent="your_app_name_here"):
+    def __init__(self, user_agent="your_app_name_here", geocode_backend=None, encoder_preset='compact'):
+        self.encoder = JpegEncoder(encoder_preset)
         self.geolocator = Nominatim(user_agent=user_agent)
+        # Hàng đợi geocode bất đồng bộ (cache theo tọa độ làm tròn, dùng chung với các
+        # entry point khác), backend có thể thay bằng server giả lập khi test. Mọi
+        # request geocode đều đi qua đây để chỉ có một bộ giới hạn 1 request/giây
+        self.geocode_queue = GeocodeQueue(geocode_backend or GeolocatorBackend(self.geolocator))
 
     def gps_to_decimal(self, gps):
         if gps is None:
@@ -19,8 +26,8 @@ class HeicProcessor:
 
     def reverse_geocode(self, latitude, longitude):
         try:
-            location = self.geolocator.reverse((latitude, longitude), language="en", timeout=10)
-            return location.address if location else "Address not found"
+            location = self.geocode_queue.submit(latitude, longitude, language="en").result()
+            return location['address'] or "Address not found"
         except Exception as e:
             print(f"Error while fetching address: {e}")
             return "Address not found"
@@ -39,40 +46,45 @@ class HeicProcessor:
             return model.strip()
         return "Device model not found"
 
-    def process_gps_info(self, exif_dict):
+    def submit_gps_lookup(self, exif_dict):
+        # Đưa tọa độ vào hàng đợi geocode chạy nền, trả về Future (hoặc None nếu không có GPS)
         if piexif.GPSIFD.GPSLatitude in exif_dict.get("GPS", {}):
             gps_info = exif_dict["GPS"]
             latitude = self.gps_to_decimal(gps_info.get(piexif.GPSIFD.GPSLatitude, None))
             longitude = self.gps_to_decimal(gps_info.get(piexif.GPSIFD.GPSLongitude, None))
 
             if latitude and longitude:
-                address = self.reverse_geocode(latitude, longitude)
-                address = [part.strip() for part in address.split(',')]
-                return [unidecode(part) for part in address]
+                return self.geocode_queue.submit(latitude, longitude, language="en")
         return None
 
+    def resolve_address(self, gps_future):
+        if gps_future is None:
+            return None
+        try:
+            location = gps_future.result()
+            address = location['address'] or "Address not found"
+        except Exception as e:
+            print(f"Error while fetching address: {e}")
+            address = "Address not found"
+        address = [part.strip() for part in address.split(',')]
+        return [unidecode(part) for part in address]
+
+    def process_gps_info(self, exif_dict):
+        return self.resolve_address(self.submit_gps_lookup(exif_dict))
+
     def convert_heic_to_jpg(self, input_path, output_path):
         try:
-            # Đọc file HEIC và lấy metadata
-            heif_file = pyheif.read(input_path)
-            metadata = heif_file.metadata
+            with open(input_path, 'rb') as f:
+                data = f.read()
+            # Đọc metadata HEIC trước, chưa decode ảnh
+            exif_data = probe(data, is_heic=True)['exif']
 
-            # Kiểm tra metadata có chứa thông tin Exif
-            exif_data = None
-            for meta in metadata:
-                if meta['type'] == 'Exif':
-                    exif_data = meta['data']
-                    break
+            # Gửi tọa độ đi geocode trước, decode/encode chạy song song trong lúc chờ
+            exif_dict = piexif.load(exif_data) if exif_data else None
+            gps_future = self.submit_gps_lookup(exif_dict) if exif_dict else None
 
             # Chuyển đổi từ HEIC sang JPG
-            image = Image.frombytes(
-                heif_file.mode,
-                heif_file.size,
-                heif_file.data,
-                "raw",
-                heif_file.mode,
-                heif_file.stride,
-            )
+            image, _ = decode(data, is_heic=True, use_cache=False)
 
             # Khởi tạo các biến kết quả
             result = {
@@ -81,20 +93,18 @@ class HeicProcessor:
                 'device_model': None
             }
 
-            if exif_data:
-                exif_dict = piexif.load(exif_data)
-                
+            if exif_dict:
+                # Lưu ảnh với exif
+                exif_bytes = piexif.dump(exif_dict)
+                self.save_jpeg(image, output_path, exif_bytes)
+
                 # Lấy thông tin thiết bị, địa chỉ và ngày chụp
                 result['device_model'] = self.get_device_model(exif_dict)
-                result['address'] = self.process_gps_info(exif_dict)
+                result['address'] = self.resolve_address(gps_future)
                 result['capture_date'] = self.get_capture_date(exif_dict)
-
-                # Lưu ảnh với exif
-                exif_bytes = piexif.dump(exif_dict)
-                image.save(output_path, format="JPEG", exif=exif_bytes)
             else:
                 # Lưu ảnh không có exif
-                image.save(output_path, format="JPEG")
+                self.save_jpeg(image, output_path)
 
             return result
 
@@ -102,6 +112,23 @@ class HeicProcessor:
             print(f"Error processing file: {e}")
             return None
 
+    def save_jpeg(self, image, output_path, exif_bytes=None):
+        with open(output_path, 'wb') as f:
+            f.write(self.encoder.encode(image, exif_bytes))
+
+    def convert_heic_batch(self, jobs):
+        # jobs: list (input_path, output_path). Gom toàn bộ tọa độ của batch vào
+        # hàng đợi geocode trước (trùng tọa độ chỉ tra một lần), rồi mới decode/encode
+        for input_path, _ in jobs:
+            try:
+                # Chỉ đọc box meta và item Exif, file được đọc đầy đủ một lần khi convert
+                exif_data = read_heif_exif_from_file(input_path)
+                if exif_data:
+                    self.submit_gps_lookup(piexif.load(exif_data))
+            except Exception as e:
+                print(f"Error reading metadata of {input_path}: {e}")
+        return [self.convert_heic_to_jpg(input_path, output_path) for input_path, output_path in jobs]
+
     def print_image_info(self, result):
         if result:
             print(f"Device: {result['device_model']}")
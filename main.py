@@ -1,23 +1,130 @@
+import copy
+import os
+from datetime import date
+
 import streamlit as st
 import streamlit_authenticator as stauth
-from modules.processor import *
+from modules.processor import REJECT_MESSAGES, get_scheduler, primary_role
+from modules.credentials import AUTH_CONFIG_PATH, load_hashed_config
+from modules.jobs import get_job_queue
+from modules.metrics import REGISTRY, summarize_timings
+
+# Seconds between job status polls while a batch is queued or running
+JOB_POLL_SECONDS = 2
+
+# Cấu hình page
+st.set_page_config(
+    page_title="Image Metadata Modifier",
+    page_icon="📷",
+    layout="wide"
+)
+
 
-import yaml
-from yaml.loader import SafeLoader
+@st.cache_resource(max_entries=2)
+def get_auth_config(path, mtime):
+    # Loaded and bcrypt-hashed once per version of the file, not on every rerun;
+    # mtime is part of the cache key so edits to config.yaml are picked up
+    return load_hashed_config(path)
 
-with open('config.yaml') as file:
-    config = yaml.load(file, Loader=SafeLoader)
 
-# Pre-hashing all plain text passwords once
-# stauth.Hasher.hash_passwords(config['credentials'])
+config = get_auth_config(AUTH_CONFIG_PATH, os.path.getmtime(AUTH_CONFIG_PATH))
 
+# Passwords are already hashed, so building the authenticator is cheap. It is
+# still built on every run: its CookieManager component belongs to the session
+# and has to be rendered each run. Each run gets its own copy of the credentials
+# because login mutates them (logged_in, failed_login_attempts).
 authenticator = stauth.Authenticate(
-    config['credentials'],
+    copy.deepcopy(config['credentials']),
     config['cookie']['name'],
     config['cookie']['key'],
-    config['cookie']['expiry_days']
+    config['cookie']['expiry_days'],
+    auto_hash=False,
 )
 
+@st.cache_resource
+def get_jobs():
+    # One job queue and background worker shared by every rerun and session
+    return get_job_queue()
+
+
+def render_job_progress(job):
+    if job['status'] == 'queued':
+        st.info(f"Job {job['id']} is queued, {job['position']} job(s) ahead")
+    else:
+        st.progress(job['done'] / job['total'] if job['total'] else 0.0)
+        st.text(f"Processing job {job['id']}: {job['done']}/{job['total']} images")
+
+
+def show_job_progress(job_id):
+    job = get_jobs().get(job_id)
+    if job is None or job['status'] not in ('queued', 'running'):
+        # Finished: rerun the whole page to show the result outside the fragment
+        st.rerun()
+    render_job_progress(job)
+
+
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+if fragment is not None:
+    # Only this block reruns while polling, the rest of the page stays untouched
+    show_job_progress = fragment(run_every=JOB_POLL_SECONDS)(show_job_progress)
+else:
+    _show_job_progress = show_job_progress
+
+    def show_job_progress(job_id):
+        _show_job_progress(job_id)
+        st.button("Refresh status")
+
+
+def show_job_result(job):
+    if job['status'] == 'failed':
+        st.error(f"Job {job['id']} failed: {job['error']}")
+        return
+    results = job['results'] or []
+    for result in results:
+        if result['rejected']:
+            st.error(f"Failed to process {result['name']}: found {REJECT_MESSAGES[result['rejected']]}")
+        elif result['error']:
+            st.error(f"Error processing {result['name']}: {result['error']}")
+        elif not result['success']:
+            st.error(f"Failed to process {result['name']}")
+
+    # The archive stays on disk for JOB_RETENTION seconds. Passing a callable
+    # means it is only read when the user clicks, not on every rerun
+    result_path = get_jobs().result_path(job['id'])
+
+    def read_archive():
+        with open(result_path, 'rb') as f:
+            return f.read()
+
+    st.download_button(
+        label="Download Processed Images (ZIP)",
+        data=read_archive,
+        file_name="processed_images.zip",
+        mime="application/zip"
+    )
+    st.success("✅ Processing complete!")
+    with st.expander("Batch metrics"):
+        rejected = {}
+        for result in results:
+            if result['rejected']:
+                rejected[result['rejected']] = rejected.get(result['rejected'], 0) + 1
+        st.write({
+            'processed': sum(1 for r in results if r['success']),
+            'rejected': rejected,
+            'errors': sum(1 for r in results if r['error']),
+            'queued_seconds': round(job['started'] - job['created'], 2),
+            'running_seconds': round(job['finished'] - job['started'], 2),
+        })
+        st.caption("Per-phase timings")
+        phases = summarize_timings(r['timings'] for r in results)
+        st.table([{'phase': phase, **stats} for phase, stats in phases.items()])
+        st.caption("Pipeline stages")
+        st.json(job['stats'])
+        st.caption("Shared scheduler (all users)")
+        st.json({'jobs': get_jobs().stats(), 'images': get_scheduler().stats()})
+        st.caption("Process-wide metrics (Prometheus text format)")
+        st.code(REGISTRY.to_prometheus(), language="text")
+
 try:
     authenticator.login()
 except Exception as e:
@@ -57,6 +164,10 @@ if st.session_state['authentication_status']:
             "📅 Select Date",
             max_value=max_date,
         )
+        keep_heic = st.checkbox(
+            "🖼️ Keep HEIC files as HEIC",
+            help="Only rewrite the EXIF of HEIC files instead of converting them to JPG",
+        )
         # time_options = ["day", "night", "random"]
         # selected_time = st.selectbox("🕒 Select Time of Day", time_options)
         authenticator.logout()
@@ -69,61 +180,33 @@ if st.session_state['authentication_status']:
     )
     
     if st.button("Process Images") and uploaded_files:
-        # Create progress bar
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        # Create a temporary directory to store uploaded files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Create a BytesIO object to store the ZIP file
-            zip_buffer = io.BytesIO()
-            
-            # Create ZIP file
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                # Process each file
-                for idx, uploaded_file in enumerate(uploaded_files):
-                    status_text.text(f"Processing {uploaded_file.name}...")
-                    
-                    # Save uploaded file to temporary directory
-                    temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-                    with open(temp_file_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    
-                    try:
-                        # Process the image
-                        output_file = process_images_in_folder_or_file(
-                            temp_file_path,
-                            new_device=selected_device,
-                            new_date=selected_date,
-                            # day_or_night=selected_time
-                        )
-                        
-                        if output_file and os.path.exists(output_file):
-                            # Add processed file to ZIP
-                            zip_file.write(
-                                output_file, 
-                                os.path.basename(output_file)
-                            )
-                        else:
-                            st.error(f"Failed to process {uploaded_file.name}")
-                    
-                    except Exception as e:
-                        st.error(f"Error processing {uploaded_file.name}: {str(e)}")
-                    
-                    # Update progress bar
-                    progress_bar.progress((idx + 1) / len(uploaded_files))
-
-            # Reset buffer position
-            zip_buffer.seek(0)
-            
-            # Create download button for ZIP file
-            st.download_button(
-                label="Download Processed Images (ZIP)",
-                data=zip_buffer,
-                file_name="processed_images.zip",
-                mime="application/zip"
-            )
-            st.success("✅ Processing complete!")
+        # The batch runs on the background job worker; this script only submits
+        # it and polls, so reruns and browser refreshes never redo or lose work
+        st.session_state['job_id'] = get_jobs().submit(
+            uploaded_files,
+            params={
+                'device': selected_device,
+                'date': selected_date.isoformat() if selected_date else None,
+                'output_format': 'heic' if keep_heic else 'jpeg',
+            },
+            owner=st.session_state['username'],
+            # Admins/editors get a larger share of the shared worker slots
+            role=primary_role(st.session_state.get('roles')),
+        )
+
+    job_id = st.session_state.get('job_id')
+    if job_id is None:
+        # After a browser refresh, pick up this user's latest job
+        recent_jobs = get_jobs().list(owner=st.session_state['username'], limit=1)
+        job_id = recent_jobs[0]['id'] if recent_jobs else None
+    if job_id is not None:
+        job = get_jobs().get(job_id)
+        if job is None:
+            st.warning("This job has expired, please process the images again")
+        elif job['status'] in ('queued', 'running'):
+            show_job_progress(job_id)
+        else:
+            show_job_result(job)
                 # Add footer
     st.markdown("---")
     st.markdown(
@@ -0,0 +1,38 @@
+import importlib
+
+# Public API của package. Submodule chỉ được import ở lần truy cập đầu tiên nên
+# `import modules` (và CLI, worker process) không phải trả giá cho Pillow, geopy, pillow_heif...
+_EXPORTS = {
+    'HeicProcessor': 'modules.processor',
+    'REJECT_MESSAGES': 'modules.processor',
+    'build_image_pipeline': 'modules.processor',
+    'process_image_bytes': 'modules.processor',
+    'process_images_in_folder_or_file': 'modules.processor',
+    'scan_images': 'modules.processor',
+    'summarize_scan': 'modules.processor',
+    'StreamingZipWriter': 'modules.archive',
+    'decode': 'modules.decoder',
+    'probe': 'modules.decoder',
+    'JpegEncoder': 'modules.encoder',
+    'CachedGeocoder': 'modules.geocache',
+    'extract_gps_batch': 'modules.gps',
+    'JobQueue': 'modules.jobs',
+    'get_job_queue': 'modules.jobs',
+    'REGISTRY': 'modules.metrics',
+    'summarize_timings': 'modules.metrics',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
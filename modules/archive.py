@@ -0,0 +1,57 @@
+import os
+import tempfile
+import zipfile
+
+# Vượt ngưỡng này thì archive được đẩy xuống file tạm trên disk
+ZIP_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+# JPEG/HEIC đã nén sẵn, deflate chỉ tốn CPU mà không giảm được dung lượng
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.heic')
+
+
+class StreamingZipWriter:
+    # path: ghi thẳng archive vào file đó (không qua buffer tạm rồi copy lại)
+    def __init__(self, max_memory_size=ZIP_SPOOL_MAX_SIZE, temp_dir=None, path=None):
+        if path is not None:
+            self.file = open(path, 'w+b')
+        else:
+            self.file = tempfile.SpooledTemporaryFile(max_size=max_memory_size, dir=temp_dir)
+        self.zip_file = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+        self.names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.zip_file.close()
+            self.file.close()
+
+    @property
+    def on_disk(self):
+        return getattr(self.file, '_rolled', True)
+
+    def unique_name(self, arcname):
+        # Tránh trùng tên entry (vd. IMG_1.heic và IMG_1.jpg đều ra IMG_1.jpg)
+        base_name, ext = os.path.splitext(arcname)
+        counter = 1
+        while arcname in self.names:
+            arcname = f"{base_name} ({counter}){ext}"
+            counter += 1
+        self.names.add(arcname)
+        return arcname
+
+    def add(self, arcname, data):
+        # Ghi entry ngay khi ảnh xử lý xong, không giữ lại bytes của ảnh
+        arcname = self.unique_name(arcname)
+        if arcname.lower().endswith(STORED_EXTENSIONS):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        self.zip_file.writestr(arcname, data, compress_type=compress_type)
+        return arcname
+
+    def close(self):
+        # Đóng central directory và trả về file archive đã seek về đầu
+        self.zip_file.close()
+        self.file.seek(0)
+        return self.file
@@ -0,0 +1,61 @@
+import logging
+import os
+import sys
+import tempfile
+
+import yaml
+from yaml.loader import SafeLoader
+
+logger = logging.getLogger(__name__)
+
+AUTH_CONFIG_PATH = os.environ.get("AUTH_CONFIG_PATH", "config.yaml")
+
+
+def load_config(path=AUTH_CONFIG_PATH):
+    with open(path, encoding='utf-8') as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def save_config(config, path=AUTH_CONFIG_PATH):
+    # Ghi file tạm rồi rename để process khác không đọc phải config ghi dở
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".yaml")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yaml.dump(config, f, sort_keys=False, allow_unicode=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def hash_credentials(credentials):
+    # Hash bcrypt các mật khẩu còn ở dạng plain text (tại chỗ), trả về số mật khẩu đã hash
+    from streamlit_authenticator import Hasher
+
+    hashed = 0
+    for user in credentials['usernames'].values():
+        if not Hasher.is_hash(user['password']):
+            user['password'] = Hasher.hash(user['password'])
+            hashed += 1
+    return hashed
+
+
+def load_hashed_config(path=AUTH_CONFIG_PATH, persist=True):
+    # Đọc config và hash mật khẩu plain text. Kết quả được ghi lại vào file nên bcrypt
+    # chỉ chạy một lần cho mỗi mật khẩu mới; file chỉ đọc thì chỉ hash trong bộ nhớ.
+    config = load_config(path)
+    hashed = hash_credentials(config['credentials'])
+    if hashed and persist:
+        try:
+            save_config(config, path)
+            logger.info("Hashed %d plain text password(s) in %s", hashed, path)
+        except OSError as e:
+            logger.warning("Could not persist hashed passwords to %s: %s", path, e)
+    return config
+
+
+if __name__ == "__main__":
+    # Hash trước mật khẩu trong config, vd. khi deploy: python -m modules.credentials config.yaml
+    logging.basicConfig(level=logging.INFO)
+    load_hashed_config(sys.argv[1] if len(sys.argv) > 1 else AUTH_CONFIG_PATH)
@@ -0,0 +1,134 @@
+import hashlib
+import importlib
+import importlib.util
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from modules.jpeg_exif import read_exif_segment
+
+# Backend decode HEIC: pillow_heif (nhanh hơn, decode đa luồng) rồi tới pyheif.
+# Chỉ kiểm tra backend có cài hay không, module được import ở lần decode HEIC đầu tiên
+HEIF_BACKENDS = ('pillow_heif', 'pyheif')
+HEIF_BACKEND = os.environ.get("HEIF_BACKEND") or next(
+    (name for name in HEIF_BACKENDS if importlib.util.find_spec(name) is not None), None
+)
+_heif_module = None
+# Số ảnh đã decode giữ lại trong LRU (mỗi ảnh 12MP ~ 36MB)
+DECODE_CACHE_SIZE = int(os.environ.get("DECODE_CACHE_SIZE", "4"))
+
+
+def is_heic_file(filename):
+    return os.path.splitext(filename)[1].lower() in ('.heic', '.heif')
+
+
+def _heif_backend():
+    global _heif_module
+    if _heif_module is None:
+        if HEIF_BACKEND not in HEIF_BACKENDS:
+            raise RuntimeError("No HEIC decoder available, install pillow_heif or pyheif")
+        _heif_module = importlib.import_module(HEIF_BACKEND)
+    return _heif_module
+
+
+def _open_heif(data):
+    # Chỉ đọc header / metadata, pixel được decode khi truy cập .data
+    backend = _heif_backend()
+    if HEIF_BACKEND == 'pillow_heif':
+        return backend.open_heif(data, convert_hdr_to_8bit=True)
+    return backend.open(data)
+
+
+def _heif_exif(heif_file):
+    if HEIF_BACKEND == 'pillow_heif':
+        return heif_file.info.get('exif')
+    for metadata in heif_file.metadata or []:
+        if metadata['type'] == 'Exif':
+            return metadata['data']
+    return None
+
+
+def probe(data, is_heic):
+    # Đọc kích thước, số kênh màu và EXIF thô mà không decode pixel
+    if is_heic:
+        heif_file = _open_heif(data)
+        return {
+            'size': heif_file.size,
+            'channels': 4 if heif_file.has_alpha else 3,
+            'exif': _heif_exif(heif_file),
+        }
+    image = Image.open(io.BytesIO(data))
+    return {
+        'size': image.size,
+        'channels': len(image.getbands()),
+        'exif': read_exif_segment(data),
+    }
+
+
+def _decode(data, is_heic):
+    if not is_heic:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image, read_exif_segment(data)
+
+    heif_file = _open_heif(data)
+    if HEIF_BACKEND == 'pyheif':
+        heif_file = heif_file.load()
+    # frombuffer dùng thẳng buffer của decoder khi mode cho phép (RGBA),
+    # các mode khác Pillow tự copy như frombytes
+    image = Image.frombuffer(
+        heif_file.mode, heif_file.size, heif_file.data, "raw", heif_file.mode, heif_file.stride, 1
+    )
+    return image, _heif_exif(heif_file)
+
+
+class DecodeCache:
+    # LRU theo hash nội dung file: xem lại cùng một ảnh trong session không phải decode lại
+    def __init__(self, max_entries=DECODE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+_decode_cache = DecodeCache()
+
+
+def decode(data, is_heic, use_cache=True):
+    # Decode JPEG/HEIC thành (PIL Image, EXIF thô hoặc None) trong một lượt.
+    # Ảnh trả về từ cache được dùng chung, caller không được sửa tại chỗ.
+    if not use_cache:
+        return _decode(data, is_heic)
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    entry = _decode_cache.get(key)
+    if entry is None:
+        entry = _decode(data, is_heic)
+        _decode_cache.set(key, entry)
+    return entry
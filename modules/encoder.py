@@ -0,0 +1,100 @@
+import importlib.util
+import io
+import os
+import time
+
+from modules.jpeg_exif import replace_exif_segment
+from modules.metrics import REGISTRY
+
+# simplejpeg (kèm numpy) chỉ được import khi thực sự encode bằng backend này
+SIMPLEJPEG_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ('numpy', 'simplejpeg'))
+
+# quality / subsampling / optimize / progressive cho từng preset; balanced giữ
+# nguyên cấu hình cũ của processor (quality=95, subsampling mặc định 4:2:0 của
+# Pillow), compact là mặc định của Pillow (quality=75) mà heictojpg vẫn dùng
+ENCODER_PRESETS = {
+    'compact': {'quality': 75, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False, 'fastdct': False},
+    'fast': {'quality': 85, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False, 'fastdct': True},
+    'balanced': {'quality': 95, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False, 'fastdct': False},
+    'archival': {'quality': 95, 'subsampling': '4:4:4', 'optimize': True, 'progressive': True, 'fastdct': False},
+}
+DEFAULT_PRESET = os.environ.get("JPEG_PRESET", "balanced")
+ENCODER_BACKENDS = ('auto', 'pillow', 'simplejpeg')
+
+ENCODE_SECONDS = REGISTRY.histogram("jpeg_encode_seconds", "JPEG encode time by preset and backend")
+ENCODE_BYTES = REGISTRY.histogram(
+    "jpeg_output_bytes", "Encoded JPEG size by preset",
+    buckets=(100e3, 250e3, 500e3, 1e6, 2e6, 4e6, 8e6, 16e6),
+)
+
+
+class JpegEncoder:
+    # Encode PIL Image sang JPEG theo preset. backend='auto' dùng simplejpeg
+    # (libjpeg-turbo, không qua lớp plugin của Pillow) cho preset không cần
+    # optimize/progressive khi đã cài, còn lại dùng Pillow.
+    def __init__(self, preset=DEFAULT_PRESET, backend='auto'):
+        if preset not in ENCODER_PRESETS:
+            raise ValueError(f"Unknown encoder preset: {preset}")
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(f"Unknown encoder backend: {backend}")
+        if backend == 'simplejpeg' and not SIMPLEJPEG_AVAILABLE:
+            raise ValueError("simplejpeg is not installed")
+        self.preset = preset
+        self.options = ENCODER_PRESETS[preset]
+        self.backend = backend
+
+    def select_backend(self, image):
+        if self.backend != 'auto':
+            return self.backend
+        if (SIMPLEJPEG_AVAILABLE and image.mode in ('RGB', 'L')
+                and not self.options['optimize'] and not self.options['progressive']):
+            return 'simplejpeg'
+        return 'pillow'
+
+    def encode(self, image, exif_bytes=None):
+        # Trả về bytes JPEG; thời gian encode và dung lượng được ghi vào metrics
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        backend = self.select_backend(image)
+        start = time.perf_counter()
+        if backend == 'simplejpeg':
+            output_data = self._encode_simplejpeg(image, exif_bytes)
+        else:
+            output_data = self._encode_pillow(image, exif_bytes)
+        ENCODE_SECONDS.observe(time.perf_counter() - start, preset=self.preset, backend=backend)
+        ENCODE_BYTES.observe(len(output_data), preset=self.preset)
+        return output_data
+
+    def _encode_pillow(self, image, exif_bytes):
+        options = self.options
+        save_kwargs = {
+            'quality': options['quality'],
+            'subsampling': options['subsampling'],
+            'optimize': options['optimize'],
+            'progressive': options['progressive'],
+        }
+        if exif_bytes:
+            save_kwargs['exif'] = exif_bytes
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", **save_kwargs)
+        return buffer.getvalue()
+
+    def _encode_simplejpeg(self, image, exif_bytes):
+        import numpy
+        import simplejpeg
+
+        options = self.options
+        pixels = numpy.asarray(image)
+        if image.mode == 'L':
+            pixels = pixels[:, :, None]
+        output_data = simplejpeg.encode_jpeg(
+            pixels,
+            quality=options['quality'],
+            colorspace='GRAY' if image.mode == 'L' else 'RGB',
+            colorsubsampling='Gray' if image.mode == 'L' else options['subsampling'].replace(':', ''),
+            fastdct=options['fastdct'],
+        )
+        # simplejpeg không ghi EXIF, chèn segment APP1 vào sau khi encode
+        if exif_bytes:
+            output_data = replace_exif_segment(output_data, exif_bytes)
+        return output_data
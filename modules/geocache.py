@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from modules.metrics import GEOCODE_CACHE_TOTAL, timed
+
+GEOCODE_CACHE_PATH = os.environ.get(
+    "GEOCODE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "app_collection", "geocode.sqlite"),
+)
+# 4 chữ số thập phân ~ 11m, ảnh cùng một buổi chụp rơi vào cùng một ô
+GEOCODE_CACHE_PRECISION = 4
+GEOCODE_CACHE_TTL = 30 * 24 * 3600
+GEOCODE_CACHE_MAX_ENTRIES = 100000
+# Nominatim cho phép tối đa 1 request/giây
+NOMINATIM_MIN_DELAY = 1.0
+
+
+class GeocodeCache:
+    def __init__(self, path=GEOCODE_CACHE_PATH, precision=GEOCODE_CACHE_PRECISION,
+                 ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Nhiều worker process có thể dùng chung một file cache
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            " lat REAL NOT NULL, lon REAL NOT NULL, language TEXT NOT NULL,"
+            " payload TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL,"
+            " PRIMARY KEY (lat, lon, language))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed)")
+        self.conn.commit()
+        self.evict()
+
+    def key(self, latitude, longitude, language):
+        return round(latitude, self.precision), round(longitude, self.precision), language
+
+    def get(self, latitude, longitude, language="en"):
+        lat, lon, language = self.key(latitude, longitude, language)
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT payload, created FROM geocode WHERE lat = ? AND lon = ? AND language = ?",
+                (lat, lon, language),
+            ).fetchone()
+            if row is None or (self.ttl and row[1] + self.ttl < now):
+                self.misses += 1
+                GEOCODE_CACHE_TOTAL.inc(result="miss")
+                return None
+            self.conn.execute(
+                "UPDATE geocode SET accessed = ? WHERE lat = ? AND lon = ? AND language = ?",
+                (now, lat, lon, language),
+            )
+            self.conn.commit()
+            self.hits += 1
+        GEOCODE_CACHE_TOTAL.inc(result="hit")
+        return json.loads(row[0])
+
+    def set(self, latitude, longitude, language, payload):
+        lat, lon, language = self.key(latitude, longitude, language)
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocode (lat, lon, language, payload, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (lat, lon, language, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            self.conn.commit()
+            self._writes += 1
+            check_size = self._writes % 100 == 0
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        # Xóa bản ghi hết hạn, sau đó xóa bản ghi ít dùng nhất khi vượt max_entries
+        with self._lock:
+            if self.ttl:
+                self.conn.execute("DELETE FROM geocode WHERE created < ?", (time.time() - self.ttl,))
+            if self.max_entries:
+                count = self.conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+                if count > self.max_entries:
+                    self.conn.execute(
+                        "DELETE FROM geocode WHERE rowid IN"
+                        " (SELECT rowid FROM geocode ORDER BY accessed LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def location_to_payload(location):
+    # Chuyển geopy Location thành dict có thể lưu JSON
+    return {
+        'address': location.address if location else None,
+        'raw': (location.raw or {}).get('address', {}) if location else {},
+    }
+
+
+class CachedGeocoder:
+    # Bọc một geocoder kiểu geopy (có .reverse(query, language=, timeout=)),
+    # chỉ gọi mạng khi cache miss và giãn cách các lần gọi theo min_delay
+    def __init__(self, geolocator, cache=None, min_delay=NOMINATIM_MIN_DELAY, timeout=10):
+        self.geolocator = geolocator
+        self.cache = cache if cache is not None else get_geocode_cache()
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._last_request = 0.0
+
+    def reverse(self, latitude, longitude, language="en"):
+        # Trả về {'address': str | None, 'raw': dict} (kết quả rỗng cũng được cache)
+        payload = self.cache.get(latitude, longitude, language)
+        if payload is not None:
+            return payload
+
+        with self._lock:
+            wait = self._last_request + self.min_delay - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with timed("geocode"):
+                    location = self.geolocator.reverse((latitude, longitude), language=language, timeout=self.timeout)
+            finally:
+                self._last_request = time.monotonic()
+
+        payload = location_to_payload(location)
+        self.cache.set(latitude, longitude, language, payload)
+        return payload
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_geocode_cache():
+    # Một GeocodeCache dùng chung cho cả process
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = GeocodeCache()
+        return _default_cache
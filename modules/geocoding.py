@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+
+from modules.geocache import get_geocode_cache, location_to_payload, NOMINATIM_MIN_DELAY
+from modules.metrics import timed
+
+
+class TokenBucket:
+    # Giới hạn số request/giây theo token bucket thay cho time.sleep cố định
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class GeolocatorBackend:
+    # Backend mặc định: bọc một geocoder kiểu geopy (Nominatim, ...).
+    # Backend khác chỉ cần có reverse(latitude, longitude, language) trả về
+    # {'address': ..., 'raw': {...}}; reverse có thể là hàm async.
+    def __init__(self, geolocator, timeout=10):
+        self.geolocator = geolocator
+        self.timeout = timeout
+
+    def reverse(self, latitude, longitude, language):
+        location = self.geolocator.reverse((latitude, longitude), language=language, timeout=self.timeout)
+        return location_to_payload(location)
+
+
+class NominatimBackend(GeolocatorBackend):
+    # domain/scheme cho phép trỏ sang server Nominatim tự host hoặc server giả lập local
+    def __init__(self, user_agent, domain=None, scheme=None, timeout=10):
+        from geopy.geocoders import Nominatim
+
+        kwargs = {}
+        if domain:
+            kwargs['domain'] = domain
+        if scheme:
+            kwargs['scheme'] = scheme
+        super().__init__(Nominatim(user_agent=user_agent, **kwargs), timeout=timeout)
+
+
+class GeocodeQueue:
+    # Hàng đợi geocode chạy trên event loop riêng (background thread):
+    # - gộp các tọa độ trùng nhau (theo ô làm tròn của cache) trong cùng batch
+    # - giới hạn tốc độ bằng token bucket
+    # - decode/encode ảnh ở thread chính vẫn chạy song song trong lúc chờ HTTP
+    def __init__(self, backend, rate=1 / NOMINATIM_MIN_DELAY, burst=1, cache=None):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.cache = cache if cache is not None else get_geocode_cache()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._bucket = None
+
+    def start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="geocode-queue", daemon=True)
+                self._thread.start()
+                self._bucket = TokenBucket(self.rate, self.burst)
+        return self
+
+    def close(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, latitude, longitude, language="en"):
+        # Trả về concurrent.futures.Future; tọa độ trùng ô dùng chung một future
+        self.start()
+        key = self.cache.key(latitude, longitude, language)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = asyncio.run_coroutine_threadsafe(
+                self._resolve(latitude, longitude, language), self._loop
+            )
+            self._pending[key] = future
+        # Xong thì bỏ khỏi _pending, lần sau sẽ lấy thẳng từ cache
+        future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def geocode_batch(self, coordinates, language="en"):
+        # coordinates: list (lat, lon); trả về payload theo đúng thứ tự
+        futures = [self.submit(latitude, longitude, language) for latitude, longitude in coordinates]
+        return [future.result() for future in futures]
+
+    async def _resolve(self, latitude, longitude, language):
+        payload = self.cache.get(latitude, longitude, language)
+        if payload is not None:
+            return payload
+
+        await self._bucket.acquire()
+        with timed("geocode"):
+            if asyncio.iscoroutinefunction(self.backend.reverse):
+                payload = await self.backend.reverse(latitude, longitude, language)
+            else:
+                payload = await asyncio.get_running_loop().run_in_executor(
+                    None, self.backend.reverse, latitude, longitude, language
+                )
+        self.cache.set(latitude, longitude, language, payload)
+        return payload
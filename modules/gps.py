@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import piexif
+
+from modules.heif_exif import read_heif_exif, read_heif_exif_from_file
+from modules.jpeg_exif import read_exif_from_file, read_exif_segment
+
+
+def dms_to_decimal(dms, ref=None):
+    # dms là ((deg_num, deg_den), (min_num, min_den), (sec_num, sec_den)) theo piexif
+    degrees, minutes, seconds = (num / den if den else 0.0 for num, den in dms)
+    value = degrees + minutes / 60.0 + seconds / 3600.0
+    if ref in (b'S', b'W', 'S', 'W'):
+        value = -value
+    return value
+
+
+def read_raw_exif(source, filename=None):
+    # source là đường dẫn file hoặc bytes; chỉ đọc block EXIF, không decode pixel
+    name = filename or (source if isinstance(source, str) else "")
+    is_heic = os.path.splitext(name)[1].lower() in ('.heic', '.heif')
+    if isinstance(source, str):
+        return read_heif_exif_from_file(source) if is_heic else read_exif_from_file(source)
+    data = bytes(source)
+    return read_heif_exif(data) if is_heic else read_exif_segment(data)
+
+
+def gps_from_exif(raw_exif):
+    # Trả về dict tọa độ từ EXIF thô, hoặc None nếu ảnh không có GPS
+    if not raw_exif:
+        return None
+    exif_dict = piexif.load(raw_exif)
+    gps = exif_dict.get("GPS", {})
+    if piexif.GPSIFD.GPSLatitude not in gps or piexif.GPSIFD.GPSLongitude not in gps:
+        return None
+    altitude = gps.get(piexif.GPSIFD.GPSAltitude)
+    date_time = exif_dict.get("Exif", {}).get(piexif.ExifIFD.DateTimeOriginal)
+    return {
+        'latitude': dms_to_decimal(gps[piexif.GPSIFD.GPSLatitude], gps.get(piexif.GPSIFD.GPSLatitudeRef)),
+        'longitude': dms_to_decimal(gps[piexif.GPSIFD.GPSLongitude], gps.get(piexif.GPSIFD.GPSLongitudeRef)),
+        'altitude': altitude[0] / altitude[1] if altitude and altitude[1] else None,
+        'datetime': date_time.decode('utf-8', 'replace') if date_time else None,
+    }
+
+
+def extract_gps(source, filename=None):
+    # Một dòng trong bảng tọa độ: file, latitude, longitude, altitude, datetime, error
+    name = filename or (source if isinstance(source, str) else None)
+    row = {'file': name, 'latitude': None, 'longitude': None, 'altitude': None, 'datetime': None, 'error': None}
+    try:
+        gps = gps_from_exif(read_raw_exif(source, filename))
+        if gps:
+            row.update(gps)
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+
+def extract_gps_batch(sources, workers=8):
+    # sources: đường dẫn file, (tên, bytes) hoặc file upload (có .name/.getvalue()).
+    # Trả về list dict theo đúng thứ tự đầu vào.
+    def run(source):
+        if isinstance(source, str):
+            return extract_gps(source)
+        if isinstance(source, tuple):
+            return extract_gps(source[1], source[0])
+        return extract_gps(source.getvalue(), source.name)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(run, sources))
+
+
+def cluster_coordinates(rows, precision=3):
+    # Gom các dòng có tọa độ làm tròn giống nhau: {(lat, lon): [chỉ số dòng]}
+    clusters = {}
+    for idx, row in enumerate(rows):
+        if row['latitude'] is None or row['longitude'] is None:
+            continue
+        key = (round(row['latitude'], precision), round(row['longitude'], precision))
+        clusters.setdefault(key, []).append(idx)
+    return clusters
@@ -0,0 +1,242 @@
+import struct
+
+from modules.jpeg_exif import EXIF_HEADER
+
+
+# Duyệt các box ISOBMFF trong data[start:end], trả về
+# (type, start, payload_start, end) với start/end tính cả header của box
+def iter_boxes(data, start=0, end=None):
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise ValueError("Truncated HEIF box header")
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"Invalid HEIF box size at offset {pos}")
+        yield box_type.decode('latin-1'), pos, pos + header, pos + size
+        pos += size
+
+
+def find_box(data, box_type, start=0, end=None):
+    for found_type, box_start, payload_start, box_end in iter_boxes(data, start, end):
+        if found_type == box_type:
+            return box_start, payload_start, box_end
+    return None
+
+
+def _read_uint(data, pos, size):
+    # Số nguyên big-endian 0/4/8 byte (kích thước field trong iloc thay đổi theo version)
+    if size == 0:
+        return 0, pos
+    return int.from_bytes(data[pos:pos + size], 'big'), pos + size
+
+
+def parse_iinf(data, payload_start, end):
+    # Trả về {item_id: item_type}
+    version = data[payload_start]
+    pos = payload_start + 4
+    pos += 2 if version == 0 else 4
+    items = {}
+    for box_type, box_start, infe_start, box_end in iter_boxes(data, pos, end):
+        if box_type != 'infe':
+            continue
+        infe_version = data[infe_start]
+        pos = infe_start + 4
+        if infe_version < 2:
+            continue
+        id_size = 2 if infe_version == 2 else 4
+        item_id, pos = _read_uint(data, pos, id_size)
+        pos += 2  # item_protection_index
+        items[item_id] = data[pos:pos + 4].decode('latin-1')
+    return items
+
+
+def parse_iloc(data, payload_start, end):
+    # Trả về {item_id: {'construction_method', 'base_offset', 'extents': [(offset, length)], ...}};
+    # 'extent_fields' giữ vị trí (trong data) của từng field offset/length để có thể ghi đè
+    version = data[payload_start]
+    pos = payload_start + 4
+    offset_size, length_size = data[pos] >> 4, data[pos] & 0x0F
+    base_offset_size = data[pos + 1] >> 4
+    index_size = data[pos + 1] & 0x0F if version in (1, 2) else 0
+    pos += 2
+    item_count, pos = _read_uint(data, pos, 2 if version < 2 else 4)
+
+    items = {}
+    for _ in range(item_count):
+        item_id, pos = _read_uint(data, pos, 2 if version < 2 else 4)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = data[pos + 1] & 0x0F
+            pos += 2
+        pos += 2  # data_reference_index
+        base_offset, pos = _read_uint(data, pos, base_offset_size)
+        extent_count, pos = _read_uint(data, pos, 2)
+        extents = []
+        extent_fields = []
+        for _ in range(extent_count):
+            pos += index_size
+            offset_pos = pos
+            extent_offset, pos = _read_uint(data, pos, offset_size)
+            length_pos = pos
+            extent_length, pos = _read_uint(data, pos, length_size)
+            extents.append((extent_offset, extent_length))
+            extent_fields.append((offset_pos, length_pos))
+        if pos > end:
+            raise ValueError("Truncated iloc box")
+        items[item_id] = {
+            'construction_method': construction_method,
+            'base_offset': base_offset,
+            'extents': extents,
+            'extent_fields': extent_fields,
+            'offset_size': offset_size,
+            'length_size': length_size,
+        }
+    return items
+
+
+def find_exif_item(meta, meta_payload_start=0, meta_end=None):
+    # Tìm item Exif trong box meta (meta là FullBox: bỏ 4 byte version/flags)
+    meta_end = len(meta) if meta_end is None else meta_end
+    children_start = meta_payload_start + 4
+    iinf = find_box(meta, 'iinf', children_start, meta_end)
+    iloc = find_box(meta, 'iloc', children_start, meta_end)
+    if iinf is None or iloc is None:
+        return None
+    item_types = parse_iinf(meta, iinf[1], iinf[2])
+    locations = parse_iloc(meta, iloc[1], iloc[2])
+    for item_id, item_type in item_types.items():
+        if item_type == 'Exif' and item_id in locations:
+            return locations[item_id]
+    return None
+
+
+def _exif_from_item(payload):
+    # Payload item Exif = 4 byte offset tới TIFF header + (prefix) + TIFF
+    if len(payload) < 4:
+        return None
+    tiff_offset = struct.unpack(">I", payload[:4])[0]
+    return EXIF_HEADER + payload[4 + tiff_offset:]
+
+
+def _read_item(location, read, meta, meta_payload_start, meta_end):
+    if location['construction_method'] == 0:
+        base = location['base_offset']
+        return b"".join(read(base + offset, length) for offset, length in location['extents'])
+    if location['construction_method'] == 1:
+        # Dữ liệu nằm trong box idat của meta
+        idat = find_box(meta, 'idat', meta_payload_start + 4, meta_end)
+        if idat is None:
+            return None
+        base = idat[1] + location['base_offset']
+        return b"".join(meta[base + offset:base + offset + length] for offset, length in location['extents'])
+    return None
+
+
+# Trả về EXIF (bắt đầu bằng "Exif\0\0") của file HEIC trong bộ nhớ, hoặc None
+def read_heif_exif(data):
+    meta = find_box(data, 'meta')
+    if meta is None:
+        return None
+    location = find_exif_item(data, meta[1], meta[2])
+    if location is None:
+        return None
+    payload = _read_item(location, lambda offset, length: data[offset:offset + length], data, meta[1], meta[2])
+    return _exif_from_item(payload) if payload else None
+
+
+# Chỉ đọc box meta và các extent của item Exif, không đọc dữ liệu ảnh (mdat)
+def read_heif_exif_from_file(path):
+    with open(path, 'rb') as f:
+        meta = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, box_type = struct.unpack(">I4s", header)
+            header_size = 8
+            if size == 1:
+                header += f.read(8)
+                size = struct.unpack(">Q", header[8:16])[0]
+                header_size = 16
+            if box_type == b'meta':
+                meta = header + f.read(size - header_size)
+                break
+            if size == 0:
+                return None
+            f.seek(size - header_size, 1)
+
+        location = find_exif_item(meta, header_size, len(meta))
+        if location is None:
+            return None
+
+        def read(offset, length):
+            f.seek(offset)
+            return f.read(length)
+
+        payload = _read_item(location, read, meta, header_size, len(meta))
+    return _exif_from_item(payload) if payload else None
+
+
+def _write_uint(buffer, pos, size, value):
+    if size == 0 or value >= 1 << (8 * size):
+        raise ValueError("Value does not fit the iloc field")
+    buffer[pos:pos + size] = value.to_bytes(size, 'big')
+
+
+# Vị trí item Exif mà replace_heif_exif ghi đè được: một extent, construction_method 0.
+# Các trường hợp khác (kể cả file chưa có item Exif) raise ValueError; caller có thể
+# gọi trước để biết ảnh sẽ phải transcode mà chưa cần EXIF mới.
+def find_replaceable_exif_item(data):
+    meta = find_box(data, 'meta')
+    if meta is None:
+        raise ValueError("No meta box in HEIF file")
+    location = find_exif_item(data, meta[1], meta[2])
+    if location is None:
+        raise ValueError("HEIF file has no Exif item")
+    if location['construction_method'] != 0 or len(location['extents']) != 1:
+        raise ValueError("Unsupported Exif item layout")
+    return location
+
+
+# Thay item Exif của file HEIC mà không đụng tới dữ liệu ảnh HEVC. Payload mới
+# vừa chỗ cũ thì ghi đè tại chỗ, không thì nối thêm một box mdat cuối file và
+# trỏ iloc sang đó. Kích thước box meta không đổi nên không offset nào khác bị lệch.
+# Layout không hỗ trợ raise ValueError để caller chuyển sang transcode.
+def replace_heif_exif(data, exif_bytes):
+    location = find_replaceable_exif_item(data)
+
+    extent_offset, extent_length = location['extents'][0]
+    offset_pos, length_pos = location['extent_fields'][0]
+    start = location['base_offset'] + extent_offset
+    old_payload = data[start:start + extent_length]
+    if len(old_payload) < 4:
+        raise ValueError("Truncated Exif item")
+
+    # Giữ nguyên quy ước của file gốc (offset 4 byte + prefix "Exif\0\0" hoặc không)
+    tiff_offset = struct.unpack(">I", old_payload[:4])[0]
+    if exif_bytes.startswith(EXIF_HEADER):
+        exif_bytes = exif_bytes[len(EXIF_HEADER):]
+    payload = old_payload[:4 + tiff_offset] + exif_bytes
+
+    output = bytearray(data)
+    if len(payload) <= extent_length:
+        output[start:start + len(payload)] = payload
+    else:
+        last_box = None
+        for last_box in iter_boxes(data):
+            pass
+        if last_box is not None and struct.unpack(">I", data[last_box[1]:last_box[1] + 4])[0] == 0:
+            raise ValueError("Last box extends to end of file")
+        new_start = len(output) + 8
+        output += struct.pack(">I4s", len(payload) + 8, b'mdat') + payload
+        _write_uint(output, offset_pos, location['offset_size'], new_start - location['base_offset'])
+    _write_uint(output, length_pos, location['length_size'], len(payload))
+    return bytes(output)
@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from datetime import date
+
+from modules.archive import StreamingZipWriter
+from modules.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.environ.get(
+    "JOBS_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "app_collection", "jobs"),
+)
+# Job đã xong (kèm file ZIP kết quả) được giữ lại 24 giờ
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", str(24 * 3600)))
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+# Số job chạy song song; slot CPU giữa các job được FairScheduler chia theo user
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "4"))
+# Thứ tự ưu tiên khi lấy job từ hàng đợi (khớp với processor.ROLE_WEIGHTS)
+ROLE_PRIORITY = {'admin': 2, 'editor': 1, 'viewer': 0}
+
+JOBS_TOTAL = REGISTRY.counter("jobs_total", "Background jobs by final status")
+JOB_SECONDS = REGISTRY.histogram(
+    "job_seconds", "Background job time by phase (queued = waiting for the worker)",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+
+# Cột được trả về trong dict job; các cột JSON được decode sẵn
+JOB_COLUMNS = ('id', 'owner', 'role', 'status', 'params', 'total', 'done', 'failed', 'created', 'started',
+               'finished', 'error', 'results', 'stats')
+JSON_COLUMNS = ('params', 'results', 'stats')
+
+
+class JobQueue:
+    # Hàng đợi job: trạng thái/tiến độ lưu trên SQLite, ảnh đầu vào giữ trong bộ
+    # nhớ tới khi worker xử lý xong, kết quả là một file <job_id>.zip. Các worker
+    # thread chạy nền, nên Streamlit rerun hay refresh trình duyệt không làm mất
+    # hoặc chạy lại batch: UI chỉ submit và poll.
+    def __init__(self, path=JOBS_DIR, retention=JOB_RETENTION, concurrency=JOB_CONCURRENCY):
+        self.path = path
+        self.retention = retention
+        self.concurrency = max(1, concurrency)
+        self._processors = {}
+        # {job_id: [(tên, bytes)]} của các job chưa chạy xong
+        self._inputs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._threads = []
+
+        os.makedirs(path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, "jobs.sqlite"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, owner TEXT, role TEXT, status TEXT NOT NULL, params TEXT NOT NULL,"
+            " total INTEGER NOT NULL, done INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL, started REAL, finished REAL, error TEXT, results TEXT, stats TEXT)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if 'role' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN role TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        # Ảnh đầu vào chỉ nằm trong bộ nhớ: job chưa xong của process trước không chạy lại được
+        self.conn.execute(
+            "UPDATE jobs SET status = 'failed', finished = ?,"
+            " error = 'Server restarted before the job finished, please upload the images again'"
+            " WHERE status IN ('queued', 'running')",
+            (time.time(),),
+        )
+        self.conn.commit()
+
+    def result_path(self, job_id):
+        return os.path.join(self.path, f"{job_id}.zip")
+
+    def submit(self, files, params=None, owner=None, role=None):
+        # files: file upload (có .name/.getvalue()) hoặc (tên, bytes). Giữ bytes của
+        # ảnh trong bộ nhớ để job không phụ thuộc vào session Streamlit đã submit
+        job_id = uuid.uuid4().hex[:12]
+        inputs = [item if isinstance(item, tuple) else (item.name, item.getvalue()) for item in files]
+        total = len(inputs)
+
+        with self._lock:
+            self._inputs[job_id] = inputs
+            self.conn.execute(
+                "INSERT INTO jobs (id, owner, role, status, params, total, created)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, owner, role, json.dumps(params or {}, default=str), total, time.time()),
+            )
+            self.conn.commit()
+            self._wakeup.notify()
+        logger.info("Queued job %s (%d images) for %s", job_id, total, owner)
+        self.start()
+        return job_id
+
+    def _row_to_job(self, row):
+        job = dict(zip(JOB_COLUMNS, row))
+        for column in JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] else None
+        if job['status'] == 'queued':
+            # Số job sẽ được lấy trước job này theo thứ tự của _claim
+            order = [row[0] for row in self._claim_order()]
+            job['position'] = order.index(job['id']) if job['id'] in order else 0
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            return self._row_to_job(row) if row else None
+
+    def list(self, owner=None, limit=20):
+        # Job mới nhất trước; owner=None trả về job của mọi người
+        query = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+        args = ()
+        if owner is not None:
+            query += " WHERE owner = ?"
+            args = (owner,)
+        query += " ORDER BY created DESC LIMIT ?"
+        with self._lock:
+            rows = self.conn.execute(query, args + (limit,)).fetchall()
+            return [self._row_to_job(row) for row in rows]
+
+    def _update(self, job_id, **fields):
+        for column in JSON_COLUMNS:
+            if column in fields:
+                fields[column] = json.dumps(fields[column], default=str)
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        with self._lock:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            self.conn.commit()
+
+    def _claim_order(self):
+        # Job queued theo thứ tự được chạy: user đang có ít job chạy nhất trước
+        # (một user không chiếm hết các worker), rồi role cao hơn, rồi job cũ hơn
+        running = {}
+        for (owner,) in self.conn.execute("SELECT owner FROM jobs WHERE status = 'running'"):
+            running[owner] = running.get(owner, 0) + 1
+        queued = self.conn.execute("SELECT id, owner, role, created FROM jobs WHERE status = 'queued'").fetchall()
+        return sorted(queued, key=lambda row: (running.get(row[1], 0), -ROLE_PRIORITY.get(row[2], 0), row[3]))
+
+    def _claim(self):
+        # Chọn job kế tiếp và chuyển sang running trong cùng một transaction
+        with self._lock:
+            order = self._claim_order()
+            if not order:
+                return None
+            job_id = order[0][0]
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job_id)
+            )
+            self.conn.commit()
+        return self.get(job_id)
+
+    def start(self):
+        # Các worker thread chạy nền, dùng chung cho mọi session trong process
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            if self._threads:
+                return
+            self._stop.clear()
+            for idx in range(self.concurrency):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{idx}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self._lock:
+            self._wakeup.notify_all()
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _worker(self):
+        while not self._stop.is_set():
+            job = self._claim()
+            if job is None:
+                self.cleanup()
+                with self._lock:
+                    if not self._stop.is_set():
+                        self._wakeup.wait(timeout=5)
+                continue
+            self.run_job(job)
+
+    def stats(self):
+        # Độ sâu hàng đợi và thời gian chờ của các job đang queued
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*), MIN(created) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall()
+        counts = {status: (count, oldest) for status, count, oldest in rows}
+        queued, oldest = counts.get('queued', (0, None))
+        return {
+            'workers': self.concurrency,
+            'running': counts.get('running', (0, None))[0],
+            'queued': queued,
+            'oldest_queued_seconds': round(now - oldest, 1) if oldest else 0.0,
+        }
+
+    def get_processor(self, output_format):
+        # Import muộn: tạo JobQueue (vd. chỉ để poll trạng thái) không kéo theo Pillow/piexif
+        from modules.processor import HeicProcessor
+
+        with self._lock:
+            if output_format not in self._processors:
+                self._processors[output_format] = HeicProcessor(output_format=output_format)
+            return self._processors[output_format]
+
+    def run_job(self, job):
+        from modules.processor import DEFAULT_ROLE, build_image_pipeline
+
+        job_id = job['id']
+        params = job['params']
+        JOB_SECONDS.observe(job['started'] - job['created'], phase="queued")
+        output_format = params.get('output_format') or 'jpeg'
+        with self._lock:
+            inputs = self._inputs.pop(job_id, None)
+        partial_path = self.result_path(job_id) + ".part"
+
+        results = []
+        done = failed = 0
+        try:
+            if inputs is None:
+                raise RuntimeError("Job inputs are no longer available")
+            new_date = date.fromisoformat(params['date']) if params.get('date') else None
+            # Ghi ZIP thẳng vào file .part rồi rename để UI không bao giờ đọc phải ZIP ghi dở
+            with StreamingZipWriter(path=partial_path) as zip_writer:
+                pipeline = build_image_pipeline(
+                    self.get_processor(output_format),
+                    new_device=params.get('device'),
+                    new_date=new_date,
+                    archive=zip_writer,
+                    output_format=output_format,
+                    owner=job['owner'],
+                    role=job['role'] or DEFAULT_ROLE,
+                )
+                # closing: lỗi giữa vòng lặp (vd. SQLite) vẫn hủy pipeline và trả slot ngay
+                with closing(pipeline.run(self._drain_inputs(inputs))) as finished_jobs:
+                    for finished_job in finished_jobs:
+                        result = finished_job['result']
+                        result['name'] = os.path.basename(result['name'])
+                        results.append(result)
+                        done += 1
+                        failed += 0 if result['success'] else 1
+                        self._update(job_id, done=done, failed=failed)
+
+                zip_writer.close().close()
+            os.replace(partial_path, self.result_path(job_id))
+            status, error = 'done', None
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            status, error = 'failed', str(e)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        finished = time.time()
+        self._update(
+            job_id, status=status, error=error, finished=finished, done=done, failed=failed,
+            results=results, stats=pipeline.stats() if status == 'done' else None,
+        )
+        JOBS_TOTAL.inc(status=status)
+        JOB_SECONDS.observe(finished - job['started'], phase="running")
+        logger.info("Job %s %s: %d/%d images, %d failed", job_id, status, done, job['total'], failed)
+
+    @staticmethod
+    def _drain_inputs(inputs):
+        # Nhả bytes của từng ảnh khỏi list ngay khi pipeline đã lấy
+        inputs.reverse()
+        while inputs:
+            yield inputs.pop()
+
+    def cleanup(self):
+        # Xóa job đã kết thúc quá retention giây cùng file ZIP của nó
+        if not self.retention:
+            return
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+                (time.time() - self.retention,),
+            ).fetchall()
+            self.conn.executemany("DELETE FROM jobs WHERE id = ?", rows)
+            self.conn.commit()
+        for (job_id,) in rows:
+            if os.path.exists(self.result_path(job_id)):
+                os.remove(self.result_path(job_id))
+
+    def close(self):
+        self.stop()
+        self.conn.close()
+
+
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    # Một JobQueue (và một worker thread) dùng chung cho cả process
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = JobQueue()
+            _default_queue.start()
+        return _default_queue
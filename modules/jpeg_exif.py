@@ -0,0 +1,102 @@
+import struct
+
+SOI = b"\xff\xd8"
+EXIF_HEADER = b"Exif\x00\x00"
+APP0 = 0xE0
+APP1 = 0xE1
+SOS = 0xDA
+EOI = 0xD9
+# Các marker không có trường độ dài
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+MAX_SEGMENT_SIZE = 0xFFFF
+
+
+# Duyệt các segment header của JPEG (từ sau SOI tới SOS), trả về
+# (marker, start, end) với start/end tính cả 2 byte marker
+def iter_segments(data):
+    if data[:2] != SOI:
+        raise ValueError("Not a JPEG file")
+    pos = 2
+    size = len(data)
+    while pos < size:
+        if data[pos] != 0xFF:
+            raise ValueError(f"Invalid JPEG marker at offset {pos}")
+        # Bỏ qua các byte fill 0xFF
+        while pos + 1 < size and data[pos + 1] == 0xFF:
+            pos += 1
+        if pos + 1 >= size:
+            break
+        marker = data[pos + 1]
+        if marker in STANDALONE_MARKERS:
+            yield marker, pos, pos + 2
+            pos += 2
+            continue
+        if marker == EOI:
+            yield marker, pos, pos + 2
+            return
+        if pos + 4 > size:
+            raise ValueError("Truncated JPEG segment")
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        end = pos + 2 + length
+        yield marker, pos, end
+        if marker == SOS:
+            return
+        pos = end
+
+
+# Trả về payload APP1/Exif (bắt đầu bằng "Exif\0\0") hoặc None
+def read_exif_segment(data):
+    for marker, start, end in iter_segments(data):
+        if marker == APP1 and data[start + 4:start + 10] == EXIF_HEADER:
+            return data[start + 4:end]
+        if marker == SOS:
+            break
+    return None
+
+
+# Ghi đè segment APP1/Exif, giữ nguyên từng byte phần còn lại của file.
+# Nếu ảnh chưa có Exif thì chèn segment mới ngay sau SOI/APP0 (JFIF).
+def replace_exif_segment(data, exif_bytes):
+    if not exif_bytes.startswith(EXIF_HEADER):
+        exif_bytes = EXIF_HEADER + exif_bytes
+    if len(exif_bytes) + 2 > MAX_SEGMENT_SIZE:
+        raise ValueError("Exif data is too big for a single APP1 segment")
+    segment = b"\xff\xe1" + struct.pack(">H", len(exif_bytes) + 2) + exif_bytes
+
+    insert_at = 2
+    for marker, start, end in iter_segments(data):
+        if marker == APP1 and data[start + 4:start + 10] == EXIF_HEADER:
+            return data[:start] + segment + data[end:]
+        if marker == APP0 and start == insert_at:
+            insert_at = end
+        if marker == SOS:
+            break
+    return data[:insert_at] + segment + data[insert_at:]
+
+
+# Chỉ đọc phần header của file JPEG (dừng ở SOS), không đọc dữ liệu ảnh nén
+def read_exif_from_file(path):
+    with open(path, 'rb') as f:
+        if f.read(2) != SOI:
+            raise ValueError("Not a JPEG file")
+        while True:
+            marker_bytes = f.read(2)
+            if len(marker_bytes) < 2:
+                return None
+            if marker_bytes[0] != 0xFF:
+                raise ValueError("Invalid JPEG marker")
+            marker = marker_bytes[1]
+            # Bỏ qua các byte fill 0xFF
+            while marker == 0xFF:
+                marker = f.read(1)[0]
+            if marker in STANDALONE_MARKERS:
+                continue
+            if marker in (SOS, EOI):
+                return None
+            length = struct.unpack(">H", f.read(2))[0]
+            if marker == APP1:
+                payload = f.read(length - 2)
+                if payload.startswith(EXIF_HEADER):
+                    return payload
+            else:
+                f.seek(length - 2, 1)
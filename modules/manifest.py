@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    # Ghi lại từng ảnh đã xử lý (hash nội dung, kích thước, tham số device/date)
+    # dạng JSON lines cạnh folder output, để lần chạy sau bỏ qua ảnh không đổi
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.path = os.path.join(output_path, MANIFEST_NAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Dòng cuối có thể bị cắt dở nếu lần chạy trước bị crash
+                    continue
+                self.entries[entry['file']] = entry
+
+    def is_unchanged(self, rel_path, size, params, digest=None):
+        # So kích thước trước, chỉ khi bằng nhau mới cần so hash. digest=None chỉ
+        # kiểm tra phần rẻ, để caller biết file nào đáng hash
+        entry = self.entries.get(rel_path)
+        if entry is None or entry['size'] != size or entry['params'] != params:
+            return False
+        if not entry.get('output') or not os.path.exists(os.path.join(self.output_path, entry['output'])):
+            return False
+        return digest is None or entry['sha256'] == digest
+
+    def record(self, rel_path, size, digest, params, output=None):
+        entry = {
+            'file': rel_path,
+            'size': size,
+            'sha256': digest,
+            'params': params,
+            'output': output,
+            'processed_at': time.time(),
+        }
+        with self._lock:
+            self.entries[rel_path] = entry
+            # Ghi nối ngay từng dòng để không mất tiến độ khi crash giữa chừng
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def compact(self):
+        # Viết lại file chỉ với bản ghi mới nhất của mỗi ảnh
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,75 @@
+import logging
+import os
+import threading
+
+from modules.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Giới hạn bộ nhớ pixel cho mỗi worker / process Streamlit (0 = không giới hạn)
+IMAGE_MEMORY_BUDGET_MB = int(os.environ.get("IMAGE_MEMORY_BUDGET_MB", "0"))
+# Giới hạn cứng RLIMIT_AS cho mỗi worker process (0 = không đặt)
+WORKER_MEMORY_LIMIT_MB = int(os.environ.get("WORKER_MEMORY_LIMIT_MB", "0"))
+
+BUDGET_WAITS = REGISTRY.counter("memory_budget_waits_total", "Times an image waited for the pixel memory budget")
+
+
+def estimate_image_bytes(size, channels=3, copies=1):
+    # Ước lượng bộ nhớ của ảnh đã decode: width * height * channels cho mỗi bản sao
+    width, height = size
+    return width * height * channels * copies
+
+
+class MemoryBudget:
+    # Chặn decode ảnh mới khi tổng bộ nhớ pixel đang giữ vượt limit. Ảnh lớn hơn
+    # cả limit vẫn được chạy khi không còn ảnh nào khác, để không bị treo mãi.
+    def __init__(self, limit_mb=IMAGE_MEMORY_BUDGET_MB):
+        self.limit = limit_mb * 1024 * 1024
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, wait=True):
+        # Trả về số byte thực sự giữ, truyền lại cho release(). wait=False giữ ngay
+        # (có thể vượt limit) cho caller không được phép chờ, vd. bước encode:
+        # chỉ encode mới giải phóng budget nên chờ ở đó có thể treo cả pipeline
+        if not self.limit:
+            return 0
+        nbytes = min(nbytes, self.limit)
+        with self._cond:
+            if wait and self.used and self.used + nbytes > self.limit:
+                BUDGET_WAITS.inc()
+                logger.debug("Waiting for %d bytes of image memory (%d in use)", nbytes, self.used)
+                while self.used and self.used + nbytes > self.limit:
+                    self._cond.wait()
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+        return nbytes
+
+    def release(self, nbytes):
+        if not nbytes:
+            return
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'limit_mb': self.limit // (1024 * 1024), 'used_mb': round(self.used / 1024 / 1024, 1),
+                    'peak_mb': round(self.peak / 1024 / 1024, 1)}
+
+
+def set_memory_limit(limit_mb=WORKER_MEMORY_LIMIT_MB):
+    # Đặt RLIMIT_AS cho process hiện tại (dùng trong initializer của worker pool)
+    if not limit_mb:
+        return
+    try:
+        import resource
+    except ImportError:
+        logger.warning("resource module not available, worker memory limit ignored")
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = limit_mb * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
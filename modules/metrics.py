@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=None):
+    items = list(label_key) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def to_prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+    def to_json(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    def __init__(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][idx] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def to_prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+    def to_json(self):
+        with self._lock:
+            return [
+                {
+                    'labels': dict(key),
+                    'count': series['count'],
+                    'sum': round(series['sum'], 6),
+                    'buckets': dict(zip(map(str, self.buckets), series['counts'])),
+                }
+                for key, series in sorted(self.series.items())
+            ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self._get(Counter, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def to_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        return {name: metric.to_json() for name, metric in list(self.metrics.items())}
+
+    def dumps(self):
+        return json.dumps(self.to_json(), indent=2)
+
+
+REGISTRY = MetricsRegistry()
+
+PHASE_SECONDS = REGISTRY.histogram(
+    "image_phase_seconds", "Time spent per processing phase (decode, orientation, exif_edit, encode, write, geocode...)"
+)
+IMAGES_TOTAL = REGISTRY.counter("images_processed_total", "Processed images by final status")
+REJECTS_TOTAL = REGISTRY.counter("images_rejected_total", "Rejected images by rule")
+GEOCODE_CACHE_TOTAL = REGISTRY.counter("geocode_cache_requests_total", "Reverse geocode cache lookups by result")
+
+
+class timed:
+    # Đo thời gian một phase: ghi vào histogram image_phase_seconds và cộng dồn
+    # vào dict timings (nếu có) để tổng hợp theo từng batch
+    def __init__(self, phase, timings=None):
+        self.phase = phase
+        self.timings = timings
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start
+        PHASE_SECONDS.observe(self.seconds, phase=self.phase)
+        if self.timings is not None:
+            self.timings[self.phase] = self.timings.get(self.phase, 0.0) + self.seconds
+        return False
+
+
+def summarize_timings(jobs_timings):
+    # Tổng hợp timings của nhiều ảnh trong một batch thành bảng theo phase
+    summary = {}
+    for timings in jobs_timings:
+        for phase, seconds in timings.items():
+            entry = summary.setdefault(phase, {'count': 0, 'total_s': 0.0, 'max_ms': 0.0})
+            entry['count'] += 1
+            entry['total_s'] += seconds
+            entry['max_ms'] = max(entry['max_ms'], seconds * 1000)
+    for entry in summary.values():
+        entry['mean_ms'] = round(entry['total_s'] / entry['count'] * 1000, 2)
+        entry['total_s'] = round(entry['total_s'], 4)
+        entry['max_ms'] = round(entry['max_ms'], 2)
+    return summary
+
+
+def count_result(result):
+    # Đếm kết quả cuối cùng của một ảnh theo trạng thái và luật loại bỏ
+    if result.get('rejected'):
+        IMAGES_TOTAL.inc(status="rejected")
+        REJECTS_TOTAL.inc(rule=result['rejected'])
+    elif result.get('success'):
+        IMAGES_TOTAL.inc(status="ok")
+    else:
+        IMAGES_TOTAL.inc(status="error")
+
+
+def merge_result(result):
+    # Ảnh xử lý trong worker process ghi metrics vào registry của process đó;
+    # process cha gộp lại từ timings đi kèm result
+    for phase, seconds in (result.get('timings') or {}).items():
+        PHASE_SECONDS.observe(seconds, phase=phase)
+    count_result(result)
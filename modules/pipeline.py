@@ -0,0 +1,175 @@
+import os
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+def _keep_error(stage_name, job, error):
+    # Mặc định: ghi lỗi vào job rồi cho đi tiếp để pipeline không bị treo
+    if isinstance(job, dict):
+        job['error'] = f"{stage_name}: {error}"
+    return job
+
+
+class Stage:
+    # Một bước của pipeline; func(job) -> job. Các bước nặng CPU (decode, encode)
+    # chạy nhiều worker thread: libheif và Pillow nhả GIL khi decode/encode.
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, busy, waiting):
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+            self.waiting += waiting
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': self.items,
+                'workers': self.workers,
+                'busy_seconds': round(self.busy, 4),
+                'wait_seconds': round(self.waiting, 4),
+                'avg_ms': round(self.busy / self.items * 1000, 2) if self.items else 0.0,
+            }
+
+
+class Pipeline:
+    # Nối các Stage bằng queue có giới hạn: số ảnh đang nằm trong pipeline không
+    # vượt quá queue_size * số stage + tổng số worker, nên bộ nhớ không tăng theo
+    # kích thước batch. Throughput bị giới hạn bởi stage chậm nhất.
+    # on_discard(job) được gọi cho các job bị bỏ dở khi consumer dừng sớm, để trả
+    # lại tài nguyên (slot scheduler, budget bộ nhớ) mà job đang giữ.
+    def __init__(self, stages, queue_size=4, on_error=None, on_discard=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error or _keep_error
+        self.on_discard = on_discard or (lambda job: None)
+        self.started = None
+        self.finished = None
+
+    def run(self, items):
+        # Generator: trả về từng job ra khỏi stage cuối (theo thứ tự hoàn thành).
+        # Consumer dừng giữa chừng (break, exception, close()) thì các stage bị hủy.
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        cancelled = threading.Event()
+        feed_error = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+        def put(target, item):
+            # put có thể hủy được: không treo mãi khi queue đầy mà pipeline đã dừng
+            while not cancelled.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(source):
+            while not cancelled.is_set():
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def feed():
+            try:
+                for item in items:
+                    if not put(queues[0], item):
+                        return
+            except Exception as e:
+                # Lỗi khi đọc danh sách đầu vào: kết thúc pipeline bình thường rồi báo lại cho consumer
+                feed_error.append(e)
+            finally:
+                for _ in range(self.stages[0].workers):
+                    put(queues[0], _DONE)
+
+        threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            next_workers = self.stages[idx + 1].workers if idx + 1 < len(self.stages) else 1
+            remaining = [stage.workers]
+            remaining_lock = threading.Lock()
+
+            def work(stage=stage, inbox=queues[idx], outbox=queues[idx + 1],
+                     next_workers=next_workers, remaining=remaining, remaining_lock=remaining_lock):
+                while True:
+                    wait_start = time.perf_counter()
+                    job = get(inbox)
+                    if job is _DONE:
+                        break
+                    start = time.perf_counter()
+                    try:
+                        job = stage.func(job)
+                    except Exception as e:
+                        job = self.on_error(stage.name, job, e)
+                    stage.record(time.perf_counter() - start, start - wait_start)
+                    if not put(outbox, job):
+                        self.on_discard(job)
+                        break
+                # Worker cuối cùng của stage báo kết thúc cho stage sau
+                with remaining_lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    for _ in range(next_workers):
+                        put(outbox, _DONE)
+
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=work, name=f"pipeline-{stage.name}-{worker}", daemon=True
+                ))
+
+        def drain():
+            for source in queues:
+                while True:
+                    try:
+                        job = source.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is not _DONE:
+                        self.on_discard(job)
+
+        for thread in threads:
+            thread.start()
+        completed = False
+        try:
+            while True:
+                job = queues[-1].get()
+                if job is _DONE:
+                    break
+                yield job
+            completed = True
+        finally:
+            if not completed:
+                cancelled.set()
+                # Trả tài nguyên của job còn trong queue trước: worker có thể đang chờ
+                # chính các slot đó, rồi mới join và dọn những job được đẩy vào sau
+                drain()
+                for thread in threads:
+                    thread.join()
+                drain()
+            self.finished = time.perf_counter()
+        if feed_error:
+            raise feed_error[0]
+
+    def stats(self):
+        end = self.finished or time.perf_counter()
+        return {
+            'wall_seconds': round(end - self.started, 4) if self.started else 0.0,
+            'stages': {stage.name: stage.stats() for stage in self.stages},
+        }
+
+
+def default_workers():
+    return max(1, (os.cpu_count() or 1) - 1)
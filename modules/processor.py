@@ -1,24 +1,203 @@
 import os
-import pyheif
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
 from PIL import Image, ExifTags
 import piexif
-from geopy.geocoders import Nominatim
-from datetime import datetime,date
-import random
 import shutil
-import streamlit as st
-import tempfile
-import io
-import zipfile
-# Cấu hình page
-st.set_page_config(
-    page_title="Image Metadata Modifier",
-    page_icon="📷",
-    layout="wide"
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from modules.geocache import CachedGeocoder
+from modules.manifest import MANIFEST_NAME, Manifest, file_digest
+from modules.pipeline import Pipeline, Stage, default_workers
+from modules.heif_exif import find_replaceable_exif_item, read_heif_exif, read_heif_exif_from_file, replace_heif_exif
+from modules.jpeg_exif import MAX_SEGMENT_SIZE, read_exif_from_file, read_exif_segment, replace_exif_segment
+from modules.decoder import decode, probe
+from modules.encoder import JpegEncoder, DEFAULT_PRESET
+from modules.memory import MemoryBudget, estimate_image_bytes, set_memory_limit, WORKER_MEMORY_LIMIT_MB
+from modules.metrics import REGISTRY, count_result, merge_result, summarize_timings, timed
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.heic')
+
+logger = logging.getLogger(__name__)
+
+# Kiểm tra lại EXIF của 1/N ảnh sau khi encode (0 = chỉ kiểm tra khi bật DEBUG)
+EXIF_VERIFY_EVERY = int(os.environ.get("EXIF_VERIFY_EVERY", "0"))
+# Chế độ tiết kiệm bộ nhớ: không xoay pixel, giữ tag Orientation cho viewer tự xoay
+LOW_MEMORY_MODE = os.environ.get("LOW_MEMORY_MODE", "").lower() in ("1", "true", "yes")
+
+ROTATING_ORIENTATIONS = (3, 6, 8)
+# Số byte EXIF có thể tăng khi sửa Model/DateTime: Exif JPEG gốc không còn đủ chỗ
+# trong một segment APP1 thì transcode, quyết định ngay từ bước decode
+EXIF_EDIT_HEADROOM = 1024
+
+# jpeg: mọi ảnh ra JPEG; heic: HEIC giữ nguyên định dạng, chỉ thay item Exif
+OUTPUT_FORMATS = ('jpeg', 'heic')
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "jpeg")
+
+REJECT_MESSAGES = {
+    "ImageDescription": "ImageDescription",
+    "XPComment": "XPComment",
+    "Douyin": "UserComment related to Douyin",
+}
+
+# Số ảnh được decode/encode cùng lúc trong cả process, chia cho mọi user
+SCHEDULER_SLOTS = int(os.environ.get("SCHEDULER_SLOTS", "0")) or os.cpu_count() or 1
+# Tỉ lệ chia slot theo role trong config.yaml: admin được gấp 4 lần viewer khi cùng chờ
+ROLE_WEIGHTS = {'admin': 4, 'editor': 2, 'viewer': 1}
+DEFAULT_ROLE = 'viewer'
+
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "scheduler_wait_seconds", "Time an image waited for a processing slot, by role",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120),
 )
+
+
+def primary_role(roles):
+    # Role có trọng số cao nhất trong danh sách roles của user
+    known = [role for role in roles or () if role in ROLE_WEIGHTS]
+    return max(known, key=ROLE_WEIGHTS.get) if known else DEFAULT_ROLE
+
+
+class FairScheduler:
+    # Chia slot CPU của cả process cho nhiều user theo weighted fair queuing: mỗi
+    # user có một virtual time tăng 1/weight cho mỗi slot đã dùng, slot trống được
+    # giao cho user đang chờ có virtual time nhỏ nhất. User mới (hoặc vừa rảnh)
+    # bắt đầu từ virtual time nhỏ nhất đang hoạt động, nên job nhỏ chỉ chờ một
+    # slot chứ không chờ hết batch lớn của người khác.
+    def __init__(self, slots=SCHEDULER_SLOTS, memory_budget=None):
+        self.slots = max(1, slots)
+        self.busy = 0
+        # Budget bộ nhớ pixel dùng chung cho mọi processor trong process
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget()
+        self.vtime = {}
+        self.active = {}
+        self.waiters = []
+        self.granted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _activate(self, owner):
+        if not self.active.get(owner):
+            others = [self.vtime[user] for user, count in self.active.items() if count and user != owner]
+            floor = min(others) if others else max(self.vtime.values(), default=0.0)
+            self.vtime[owner] = max(self.vtime.get(owner, 0.0), floor)
+        self.active[owner] = self.active.get(owner, 0) + 1
+
+    def _deactivate(self, owner):
+        self.active[owner] -= 1
+        if not self.active[owner]:
+            del self.active[owner]
+
+    def _next(self):
+        return min(self.waiters, key=lambda ticket: (self.vtime[ticket[1]], ticket[0]))
+
+    def acquire(self, owner=None, role=DEFAULT_ROLE):
+        start = time.perf_counter()
+        with self._cond:
+            # active đếm cả slot đang giữ lẫn lượt đang chờ của user
+            self._activate(owner)
+            ticket = (next(self._seq), owner)
+            self.waiters.append(ticket)
+            while self.busy >= self.slots or self._next() is not ticket:
+                self._cond.wait()
+            self.waiters.remove(ticket)
+            self.busy += 1
+            self.vtime[owner] += 1.0 / ROLE_WEIGHTS.get(role, 1)
+            waited = time.perf_counter() - start
+            self.granted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            # Còn slot trống thì người chờ kế tiếp không phải đợi lần release sau
+            self._cond.notify_all()
+        SCHEDULER_WAIT_SECONDS.observe(waited, role=role)
+
+    def release(self, owner=None):
+        with self._cond:
+            self.busy -= 1
+            self._deactivate(owner)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, owner=None, role=DEFAULT_ROLE):
+        self.acquire(owner, role)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+    def stats(self):
+        with self._cond:
+            waiting = {}
+            for _, owner in self.waiters:
+                waiting[owner] = waiting.get(owner, 0) + 1
+            return {
+                'slots': self.slots,
+                'busy': self.busy,
+                'queue_depth': len(self.waiters),
+                'waiting_by_user': waiting,
+                'granted': self.granted,
+                'mean_wait_ms': round(self.wait_total / self.granted * 1000, 2) if self.granted else 0.0,
+                'max_wait_ms': round(self.wait_max * 1000, 2),
+                'memory': self.memory_budget.stats(),
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # Một FairScheduler cho cả process: mọi session/job Streamlit dùng chung
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler()
+        return _scheduler
+
 class HeicProcessor:
-    def __init__(self, user_agent="your_app_name_here"):
-        self.geolocator = Nominatim(user_agent=user_agent)
+    def __init__(self, user_agent="your_app_name_here", verify_every=EXIF_VERIFY_EVERY, low_memory=LOW_MEMORY_MODE,
+                 memory_budget=None, encoder_preset=DEFAULT_PRESET, output_format=OUTPUT_FORMAT):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.user_agent = user_agent
+        self.output_format = output_format
+        self.encoder = JpegEncoder(encoder_preset)
+        self.verify_every = verify_every
+        self.low_memory = low_memory
+        # Mặc định dùng budget bộ nhớ pixel chung của cả process (qua scheduler)
+        self.memory_budget = memory_budget if memory_budget is not None else get_scheduler().memory_budget
+        self._encoded = itertools.count(1)
+        self._geolocator = None
+        self._geocoder = None
+
+    def worker_options(self):
+        # Cấu hình truyền sang worker process để tạo HeicProcessor giống hệt
+        return {
+            'verify_every': self.verify_every,
+            'low_memory': self.low_memory,
+            'encoder_preset': self.encoder.preset,
+            'output_format': self.output_format,
+        }
+
+    @property
+    def geolocator(self):
+        # Chỉ tạo Nominatim client khi thực sự cần reverse geocode
+        if self._geolocator is None:
+            from geopy.geocoders import Nominatim
+
+            self._geolocator = Nominatim(user_agent=self.user_agent)
+        return self._geolocator
+
+    @property
+    def geocoder(self):
+        # Cache reverse geocode theo tọa độ làm tròn, dùng chung với các entry point khác
+        if self._geocoder is None:
+            self._geocoder = CachedGeocoder(self.geolocator)
+        return self._geocoder
 
     def gps_to_decimal(self, gps):
         if gps is None:
@@ -30,26 +209,28 @@ class HeicProcessor:
 
     def reverse_geocode(self, latitude, longitude):
         try:
-            location = self.geolocator.reverse((latitude, longitude), language="en", timeout=10)
-            return location.address if location else "Address not found"
+            location = self.geocoder.reverse(latitude, longitude, language="en")
+            return location['address'] or "Address not found"
         except Exception as e:
-            print(f"Error while fetching address: {e}")
+            logger.warning("Error while fetching address: %s", e)
             return "Address not found"
 
+    def rotate_image(self, image, orientation):
+        if orientation == 6:  # Xoay 90 độ
+            return image.transpose(Image.ROTATE_270)
+        if orientation == 8:  # Xoay -90 độ
+            return image.transpose(Image.ROTATE_90)
+        if orientation == 3:  # Xoay 180 độ
+            return image.transpose(Image.ROTATE_180)
+        return image
+
     def fix_image_orientation(self, image, heif_metadata=None):
         try:
             if heif_metadata:  # Xử lý cho file HEIC
                 for metadata in heif_metadata:
                     if metadata['type'] == 'Exif':
                         exif_dict = piexif.load(metadata['data'])
-                        if piexif.ImageIFD.Orientation in exif_dict.get("0th", {}):
-                            orientation = exif_dict["0th"][piexif.ImageIFD.Orientation]
-                            if orientation == 6:  # Xoay 90 độ
-                                image = image.transpose(Image.ROTATE_270)
-                            elif orientation == 8:  # Xoay -90 độ
-                                image = image.transpose(Image.ROTATE_90)
-                            elif orientation == 3:  # Xoay 180 độ
-                                image = image.transpose(Image.ROTATE_180)
+                        image = self.rotate_image(image, exif_dict.get("0th", {}).get(piexif.ImageIFD.Orientation))
                         break
             else:  # Xử lý cho file JPG
                 for orientation in ExifTags.TAGS.keys():
@@ -57,178 +238,628 @@ class HeicProcessor:
                         break
                 exif = image._getexif()
                 if exif is not None and orientation in exif:
-                    if exif[orientation] == 3:
-                        image = image.transpose(Image.ROTATE_180)
-                    elif exif[orientation] == 6:
-                        image = image.transpose(Image.ROTATE_270)
-                    elif exif[orientation] == 8:
-                        image = image.transpose(Image.ROTATE_90)
+                    image = self.rotate_image(image, exif[orientation])
             return image
         except (AttributeError, KeyError, IndexError):
             return image
 
-    def modify_image_metadata(self, image_path, output_path, new_device=None, new_date=None):
+    def get_reject_reason(self, exif_dict):
+        # Ảnh có description / comment / dấu vết Douyin sẽ bị loại
+        if "0th" in exif_dict:
+            if piexif.ImageIFD.ImageDescription in exif_dict["0th"]:
+                return "ImageDescription"
+            if piexif.ImageIFD.XPComment in exif_dict["0th"]:
+                return "XPComment"
+
+        if "Exif" in exif_dict and piexif.ExifIFD.UserComment in exif_dict["Exif"]:
+            user_comment = exif_dict["Exif"][piexif.ExifIFD.UserComment]
+            if b'Douyin' in user_comment or b'douyin_beauty_me' in user_comment:
+                return "Douyin"
+        return None
+
+    def get_original_datetime(self, exif_dict):
+        if "0th" in exif_dict and piexif.ImageIFD.DateTime in exif_dict["0th"]:
+            return exif_dict["0th"][piexif.ImageIFD.DateTime].decode('utf-8')
+        if "Exif" in exif_dict and piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"]:
+            return exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal].decode('utf-8')
+        return None
+
+    def read_exif(self, image_path):
+        # Chỉ đọc block EXIF của file, không decode pixel
+        if os.path.splitext(image_path)[1].lower() == '.heic':
+            exif_segment = read_heif_exif_from_file(image_path)
+        else:
+            exif_segment = read_exif_from_file(image_path)
+        if exif_segment:
+            return piexif.load(exif_segment)
+        return {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+
+    def scan_image(self, image_path):
+        # Báo cáo ảnh sẽ được xử lý thế nào mà không decode / ghi file
+        is_heic = os.path.splitext(image_path)[1].lower() == '.heic'
+        report = {
+            'file': image_path,
+            'format': 'HEIC' if is_heic else 'JPEG',
+            'rejected': None,
+            'has_gps': False,
+            'datetime': None,
+            'error': None,
+        }
         try:
-            base_name, ext = os.path.splitext(os.path.basename(image_path))
-            output_file = os.path.join(output_path, f"{base_name}.jpg")
+            exif_dict = self.read_exif(image_path)
+            report['rejected'] = self.get_reject_reason(exif_dict)
+            report['has_gps'] = piexif.GPSIFD.GPSLatitude in exif_dict.get("GPS", {})
+            report['datetime'] = self.get_original_datetime(exif_dict)
+        except Exception as e:
+            report['error'] = str(e)
+        return report
+
+    def update_exif(self, exif_dict, new_device=None, new_date=None, keep_orientation=False):
+        # Thay đổi model thiết bị nếu được chỉ định
+        if new_device and "0th" in exif_dict:
+            exif_dict["0th"][piexif.ImageIFD.Model] = new_device.encode('utf-8')
+
+        # Thay đổi ngày nhưng giữ nguyên giờ phút giây
+        if new_date:
+            # Lấy giờ phút giây từ metadata gốc
+            original_time = None
+            original_datetime = self.get_original_datetime(exif_dict)
+            if original_datetime:
+                original_time = original_datetime.split(' ')[1]
             
-            # Xử lý định dạng .HEIC
-            if ext.lower() == '.heic':
-                heif_file = pyheif.read(image_path)
-                image = Image.frombytes(
-                    heif_file.mode,
-                    heif_file.size,
-                    heif_file.data,
-                    "raw",
-                    heif_file.mode,
-                    heif_file.stride,
-                )
-                # Fix orientation cho HEIC
-                image = self.fix_image_orientation(image, heif_file.metadata)
-                
-                exif_dict = {}
-                for metadata in heif_file.metadata or []:
-                    if metadata['type'] == 'Exif':
-                        exif_dict = piexif.load(metadata['data'])
-                        break
-                else:
-                    exif_dict = {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
-            else:
-                image = Image.open(image_path)
-                # Fix orientation cho JPG
-                image = self.fix_image_orientation(image)
-                exif_dict = piexif.load(image.info.get('exif', b'')) if 'exif' in image.info else {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+            # Nếu không có thời gian gốc, sử dụng thời gian mặc định 12:00:00
+            if not original_time:
+                original_time = "12:00:00"
 
-            # Kiểm tra và xóa ảnh nếu có description
+            # Kết hợp ngày mới với thời gian gốc
+            new_datetime = f"{new_date.strftime('%Y:%m:%d')} {original_time}"
+            datetime_bytes = new_datetime.encode('utf-8')
+            
+            # Cập nhật các trường datetime
             if "0th" in exif_dict:
-                if piexif.ImageIFD.ImageDescription in exif_dict["0th"]:
-                    print(f"Found ImageDescription in {image_path}. Deleting the file.")
-                    os.remove(image_path)
-                    return False
-                if piexif.ImageIFD.XPComment in exif_dict["0th"]:
-                    print(f"Found XPComment in {image_path}. Deleting the file.")
-                    os.remove(image_path)
-                    return False
-
-            if "Exif" in exif_dict and piexif.ExifIFD.UserComment in exif_dict["Exif"]:
-                user_comment = exif_dict["Exif"][piexif.ExifIFD.UserComment]
-                if b'Douyin' in user_comment or b'douyin_beauty_me' in user_comment:
-                    print(f"Found UserComment related to Douyin in {image_path}. Deleting the file.")
-                    os.remove(image_path)
-                    return False
-
-            # Thay đổi model thiết bị nếu được chỉ định
-            if new_device and "0th" in exif_dict:
-                exif_dict["0th"][piexif.ImageIFD.Model] = new_device.encode('utf-8')
-
-            # Thay đổi ngày nhưng giữ nguyên giờ phút giây
-            if new_date:
-                try:
-                    # Lấy giờ phút giây từ metadata gốc
-                    original_time = None
-                    if "0th" in exif_dict and piexif.ImageIFD.DateTime in exif_dict["0th"]:
-                        original_datetime = exif_dict["0th"][piexif.ImageIFD.DateTime].decode('utf-8')
-                        original_time = original_datetime.split(' ')[1]
-                    elif "Exif" in exif_dict and piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"]:
-                        original_datetime = exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal].decode('utf-8')
-                        original_time = original_datetime.split(' ')[1]
-                    
-                    # Nếu không có thời gian gốc, sử dụng thời gian mặc định 12:00:00
-                    if not original_time:
-                        original_time = "12:00:00"
+                exif_dict["0th"][piexif.ImageIFD.DateTime] = datetime_bytes
+            if "Exif" in exif_dict:
+                exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = datetime_bytes
+                exif_dict["Exif"][piexif.ExifIFD.DateTimeDigitized] = datetime_bytes
 
-                    # Kết hợp ngày mới với thời gian gốc
-                    new_datetime = f"{new_date.strftime('%Y:%m:%d')} {original_time}"
-                    datetime_bytes = new_datetime.encode('utf-8')
-                    
-                    # Cập nhật các trường datetime
-                    if "0th" in exif_dict:
-                        exif_dict["0th"][piexif.ImageIFD.DateTime] = datetime_bytes
-                    if "Exif" in exif_dict:
-                        exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = datetime_bytes
-                        exif_dict["Exif"][piexif.ExifIFD.DateTimeDigitized] = datetime_bytes
-                    
+        # Loại bỏ thông tin Orientation để tránh xoay ảnh (trừ khi pixel chưa được xoay)
+        if not keep_orientation and "0th" in exif_dict and piexif.ImageIFD.Orientation in exif_dict["0th"]:
+            del exif_dict["0th"][piexif.ImageIFD.Orientation]
+        return exif_dict
+
+    def new_job(self, data, filename, output_format=None):
+        # Trạng thái của một ảnh đi qua các bước decode -> sửa EXIF -> encode
+        return {
+            'name': filename,
+            'data': data,
+            'is_heic': os.path.splitext(filename)[1].lower() == '.heic',
+            'output_format': output_format or self.output_format,
+            'info': None,
+            'exif_dict': None,
+            'exif_bytes': None,
+            'image': None,
+            'keep_orientation': False,
+            'reserved': 0,
+            'output_data': None,
+            'result': {'file': filename, 'success': False, 'output': None, 'rejected': None, 'error': None,
+                       'timings': {}},
+        }
+
+    def decode_image(self, job):
+        # Chỉ đọc metadata trước, chưa decode pixel
+        data = job['data']
+        timings = job['result']['timings']
+        with timed('metadata', timings):
+            info = job['info'] = probe(data, job['is_heic'])
+            exif_dict = piexif.load(info['exif']) if info['exif'] else {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+        job['exif_dict'] = exif_dict
+
+        # Ảnh bị loại thì dừng luôn, không tốn công decode
+        job['result']['rejected'] = self.get_reject_reason(exif_dict)
+        if job['result']['rejected']:
+            job['data'] = None
+            return job
+
+        keep_heic = job['is_heic'] and job['output_format'] == 'heic'
+        orientation = exif_dict.get("0th", {}).get(piexif.ImageIFD.Orientation)
+        rotate = orientation in ROTATING_ORIENTATIONS
+        # Giữ HEIC / low-memory: không xoay pixel, giữ tag Orientation trong EXIF output
+        job['keep_orientation'] = keep_heic or (rotate and self.low_memory)
+        rotate = rotate and not job['keep_orientation']
+
+        # HEIC ra JPEG luôn phải decode; JPEG chỉ decode khi cần xoay pixel,
+        # còn lại ghi đè thẳng segment / item Exif. Ảnh không ghi đè được cũng
+        # decode luôn ở đây: bộ nhớ chỉ được chờ ở bước decode, không phải ở encode
+        if (job['is_heic'] and not keep_heic) or rotate or not self.can_replace_exif(job):
+            self.load_pixels(job, orientation if rotate else None)
+        return job
+
+    def can_replace_exif(self, job):
+        # HEIC: item Exif phải có layout mà replace_heif_exif hỗ trợ;
+        # JPEG: Exif sau khi sửa vẫn phải vừa một segment APP1
+        if job['is_heic']:
+            try:
+                find_replaceable_exif_item(job['data'])
+            except ValueError as e:
+                logger.info("Re-encoding %s as JPEG: %s", job['name'], e)
+                return False
+            return True
+        exif = job['info']['exif'] or b""
+        if len(exif) + 2 + EXIF_EDIT_HEADROOM > MAX_SEGMENT_SIZE:
+            logger.info("Re-encoding %s: Exif data is too big to rewrite in place", job['name'])
+            return False
+        return True
+
+    def load_pixels(self, job, orientation=None, wait=True):
+        # Decode ảnh của job (xoay theo orientation nếu có), tính vào memory budget
+        info = job['info']
+        timings = job['result']['timings']
+        rotate = orientation in ROTATING_ORIENTATIONS
+        # Buffer của decoder + bản copy của Pillow (HEIC không zero-copy được) + bản xoay
+        copies = 1 + (job['is_heic'] and info['channels'] != 4) + rotate
+        self.reserve_memory(job, estimate_image_bytes(info['size'], info['channels'], copies), wait=wait)
+        with timed('decode', timings):
+            # Không dùng LRU của decoder: mỗi ảnh chỉ đi qua một lần và
+            # bộ nhớ đã được tính vào memory budget
+            image, _ = decode(job['data'], job['is_heic'], use_cache=False)
+        if rotate:
+            with timed('orientation', timings):
+                image = self.rotate_image(image, orientation)
+        job['image'] = image
+        if job['is_heic']:
+            job['data'] = None
+        return job
+
+    def reserve_memory(self, job, nbytes, wait=True):
+        # Chờ đến khi budget đủ chỗ cho ảnh sắp decode; giải phóng trong release_memory
+        job['reserved'] += self.memory_budget.acquire(nbytes, wait=wait)
+
+    def release_memory(self, job):
+        reserved, job['reserved'] = job['reserved'], 0
+        self.memory_budget.release(reserved)
+
+    def edit_image(self, job, new_device=None, new_date=None):
+        with timed('exif_edit', job['result']['timings']):
+            self.update_exif(job['exif_dict'], new_device=new_device, new_date=new_date,
+                             keep_orientation=job['keep_orientation'])
+            job['exif_bytes'] = piexif.dump(job['exif_dict'])
+        return job
+
+    def encode_image(self, job, new_device=None, new_date=None):
+        image = job['image']
+        exif_bytes = job['exif_bytes']
+        timings = job['result']['timings']
+        output_data = None
+        output_ext = ".jpg"
+        with timed('encode', timings):
+            if image is None:
+                try:
+                    if job['is_heic']:
+                        # HEIC: giữ nguyên dữ liệu HEVC, chỉ thay item Exif trong container
+                        output_data = replace_heif_exif(job['data'], exif_bytes)
+                        output_ext = ".heic"
+                    else:
+                        # JPEG: giữ nguyên dữ liệu nén, chỉ thay segment APP1/Exif
+                        output_data = replace_exif_segment(job['data'], exif_bytes)
                 except ValueError as e:
-                    print(f"Invalid date format. Error: {e}")
-                    return False
+                    # Hiếm khi tới đây (can_replace_exif đã lọc ở bước decode). Không chờ
+                    # budget: chỉ encode mới giải phóng được bộ nhớ mà các ảnh khác đang giữ
+                    logger.info("Re-encoding %s as JPEG: %s", job['name'], e)
+                    image = self.load_pixels(job, wait=False)['image']
+            if image is not None:
+                output_data = self.encoder.encode(image, exif_bytes)
 
-            # Loại bỏ thông tin Orientation để tránh xoay ảnh
-            if "0th" in exif_dict and piexif.ImageIFD.Orientation in exif_dict["0th"]:
-                del exif_dict["0th"][piexif.ImageIFD.Orientation]
+        if self.should_verify():
+            with timed('verify', timings):
+                self.verify_output(output_data, exif_bytes, job['name'], is_heic=output_ext == ".heic")
 
-            # Lưu lại EXIF data vào ảnh trong thư mục output
-            exif_bytes = piexif.dump(exif_dict)
-            image.save(output_file, format="JPEG", exif=exif_bytes, quality=95)
-            
-            # Xác nhận thay đổi
-            verification = piexif.load(output_file)
-            print("Verification after modification:")
-            if new_device and piexif.ImageIFD.Model in verification['0th']:
-                print(f"Device: {verification['0th'][piexif.ImageIFD.Model].decode('utf-8')}")
-            if new_date and piexif.ImageIFD.DateTime in verification['0th']:
-                print(f"Date: {verification['0th'][piexif.ImageIFD.DateTime].decode('utf-8')}")
-            
+        # Giải phóng ảnh gốc ngay khi encode xong
+        job['image'] = None
+        job['data'] = None
+        self.release_memory(job)
+        job['output_data'] = output_data
+        job['result']['success'] = True
+        job['result']['output'] = os.path.splitext(os.path.basename(job['name']))[0] + output_ext
+        return job
+
+    def should_verify(self):
+        # Lấy mẫu 1/verify_every ảnh, hoặc kiểm tra mọi ảnh khi log ở mức DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
             return True
+        return self.verify_every > 0 and next(self._encoded) % self.verify_every == 0
+
+    def verify_output(self, output_data, exif_bytes, name=None, is_heic=False):
+        # So segment / item Exif của output với exif_bytes vừa dump, không đọc lại file
+        output_exif = read_heif_exif(output_data) if is_heic else read_exif_segment(output_data)
+        if output_exif != exif_bytes:
+            raise ValueError(f"EXIF verification failed for {name}")
+        logger.debug("Verified EXIF for %s", name)
+
+    def modify_image_bytes(self, data, filename, new_device=None, new_date=None, output_format=None):
+        # Xử lý hoàn toàn trong bộ nhớ: nhận bytes ảnh gốc, trả về
+        # (bytes JPEG/HEIC đã sửa hoặc None, result)
+        job = self.new_job(None, filename, output_format)
+        result = job['result']
+        try:
+            job['data'] = bytes(data)
+            self.decode_image(job)
+            if result['rejected']:
+                return None, result
+
+            try:
+                self.edit_image(job, new_device=new_device, new_date=new_date)
+            except ValueError as e:
+                logger.warning("Invalid date format. Error: %s", e)
+                result['error'] = str(e)
+                return None, result
+
+            self.encode_image(job, new_device=new_device, new_date=new_date)
+            return job['output_data'], result
 
         except Exception as e:
-            print(f"Error modifying metadata: {e}")
+            logger.error("Error modifying metadata for %s: %s", filename, e)
+            result['error'] = str(e)
+            return None, result
+        finally:
+            self.release_memory(job)
+            count_result(result)
+
+    def modify_image_file(self, image_path, output_path, new_device=None, new_date=None, output_format=None,
+                          digest=False):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        output_data, result = self.modify_image_bytes(data, image_path, new_device=new_device, new_date=new_date,
+                                                      output_format=output_format)
+        if digest:
+            # Hash cho manifest từ bytes đã đọc, không phải đọc lại file
+            result['sha256'] = hashlib.sha256(data).hexdigest()
+
+        # Kiểm tra và xóa ảnh nếu bị loại
+        if result['rejected']:
+            logger.info("Found %s in %s. Deleting the file.", REJECT_MESSAGES[result['rejected']], image_path)
+            os.remove(image_path)
+            return result
+
+        if output_data is not None:
+            # Lưu lại ảnh vào thư mục output
+            output_file = os.path.join(output_path, result['output'])
+            with timed('write', result['timings']):
+                with open(output_file, 'wb') as f:
+                    f.write(output_data)
+            result['output'] = output_file
+        return result
+
+    def modify_image_metadata(self, image_path, output_path, new_device=None, new_date=None):
+        try:
+            return self.modify_image_file(image_path, output_path, new_device=new_device, new_date=new_date)['success']
+        except Exception as e:
+            logger.error("Error modifying metadata for %s: %s", image_path, e)
             return False
 
-def process_images_in_folder_or_file(input_path, new_device=None, new_date=None):
-    processor = HeicProcessor()
+def process_image_bytes(data, filename, new_device=None, new_date=None, processor=None, output_format=None):
+    # data có thể là bytes, bytearray, memoryview hoặc file-like (UploadedFile, BytesIO...)
+    if hasattr(data, 'read'):
+        data = data.read()
+    processor = processor or HeicProcessor()
+    return processor.modify_image_bytes(data, filename, new_device=new_device, new_date=new_date,
+                                        output_format=output_format)
 
-    # Tạo tên folder output
+# Mỗi worker process giữ một HeicProcessor riêng, tạo một lần khi khởi động
+_worker_processor = None
+
+def _init_worker(memory_limit_mb=WORKER_MEMORY_LIMIT_MB, options=None):
+    global _worker_processor
+    set_memory_limit(memory_limit_mb)
+    _worker_processor = HeicProcessor(**(options or {}))
+
+def _process_image_task(task, processor=None):
+    image_path, output_path, new_device, new_date, digest = task
+    processor = processor or _worker_processor or HeicProcessor()
+    try:
+        return processor.modify_image_file(
+            image_path,
+            output_path,
+            new_device=new_device,
+            new_date=new_date,
+            digest=digest,
+        )
+    except Exception as e:
+        return {'file': image_path, 'success': False, 'output': None, 'rejected': None, 'error': str(e)}
+
+def _run_image_tasks(tasks, workers=None, processor=None, callback=None):
+    # Chia decode HEIC / sửa EXIF / encode JPEG cho nhiều process.
+    # Kết quả trả về theo đúng thứ tự của tasks; callback(idx, result)
+    # được gọi ngay khi từng ảnh xong (dùng cho progress).
+    if not tasks:
+        return []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+
+    results = []
+    if workers == 1:
+        processor = processor or HeicProcessor()
+        for task in tasks:
+            results.append(_process_image_task(task, processor))
+            if callback:
+                callback(len(results) - 1, results[-1])
+        return results
+
+    chunksize = max(1, len(tasks) // (workers * 4))
+    initargs = (WORKER_MEMORY_LIMIT_MB, processor.worker_options() if processor else None)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        for result in executor.map(_process_image_task, tasks, chunksize=chunksize):
+            merge_result(result)
+            results.append(result)
+            if callback:
+                callback(len(results) - 1, result)
+    return results
+
+def find_image_files(input_path, recursive=False):
+    if not recursive:
+        return [
+            os.path.join(input_path, f)
+            for f in sorted(os.listdir(input_path))
+            if f.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    image_paths = []
+    for root, dirs, files in os.walk(input_path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                image_paths.append(os.path.join(root, f))
+    return image_paths
+
+def scan_images(input_path, recursive=True, workers=8, processor=None):
+    # Dry-run: chỉ đọc metadata, không decode pixel và không ghi gì ra disk
+    processor = processor or HeicProcessor()
     if os.path.isdir(input_path):
-        output_path = input_path + "_output"
+        image_paths = find_image_files(input_path, recursive=recursive)
     else:
-        # Nếu là file, tạo folder output cùng cấp với file input
-        parent_dir = os.path.dirname(input_path)
-        base_name = os.path.splitext(os.path.basename(input_path))[0]
-        output_path = os.path.join(parent_dir, base_name + "_output")
+        image_paths = [input_path]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(processor.scan_image, image_paths))
+
+def summarize_scan(reports):
+    summary = {
+        'total': len(reports),
+        'heic': sum(1 for r in reports if r['format'] == 'HEIC'),
+        'jpeg': sum(1 for r in reports if r['format'] == 'JPEG'),
+        'has_gps': sum(1 for r in reports if r['has_gps']),
+        'errors': sum(1 for r in reports if r['error']),
+        'rejected': {},
+    }
+    for r in reports:
+        if r['rejected']:
+            summary['rejected'][r['rejected']] = summary['rejected'].get(r['rejected'], 0) + 1
+    return summary
+
+def build_image_pipeline(processor=None, new_device=None, new_date=None, archive=None, workers=None,
+                         queue_size=4, output_format=None, owner=None, role=DEFAULT_ROLE, scheduler=None):
+    # Pipeline read -> decode -> sửa EXIF -> encode -> ghi ZIP với queue giới hạn
+    # giữa các bước; decode/encode chạy trên nhiều worker, đọc/ghi chạy song song.
+    # Item đầu vào là file upload (có .name/.getvalue()), (tên, bytes) hoặc đường dẫn file.
+    # Mỗi ảnh giữ một slot của scheduler (theo owner/role) từ decode tới hết encode.
+    processor = processor or HeicProcessor()
+    scheduler = scheduler or get_scheduler()
+    workers = workers or default_workers()
+
+    def is_finished(job):
+        return job['result']['rejected'] or job['result']['error']
+
+    def read(source):
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                job = processor.new_job(f.read(), source, output_format)
+        elif isinstance(source, tuple):
+            job = processor.new_job(source[1], source[0], output_format)
+        else:
+            job = processor.new_job(source.getvalue(), source.name, output_format)
+        job['result']['name'] = job['name']
+        return job
+
+    def release_slot(job):
+        if job.pop('slot', False):
+            scheduler.release(owner)
+
+    def decode(job):
+        if is_finished(job):
+            return job
+        scheduler.acquire(owner, role)
+        job['slot'] = True
+        try:
+            processor.decode_image(job)
+        except Exception:
+            release_slot(job)
+            raise
+        if is_finished(job):
+            release_slot(job)
+        return job
+
+    def edit(job):
+        return job if is_finished(job) else processor.edit_image(job, new_device=new_device, new_date=new_date)
+
+    def encode(job):
+        try:
+            return job if is_finished(job) else processor.encode_image(job, new_device=new_device, new_date=new_date)
+        finally:
+            release_slot(job)
+
+    def write(job):
+        if archive is not None and job['output_data'] is not None:
+            with timed('write', job['result']['timings']):
+                job['result']['output'] = archive.add(job['result']['output'], job['output_data'])
+            job['output_data'] = None
+        count_result(job['result'])
+        return job
+
+    def on_error(stage_name, job, error):
+        logger.error("Error modifying metadata (%s): %s", stage_name, error)
+        if isinstance(job, dict):
+            release_slot(job)
+            processor.release_memory(job)
+        else:
+            name = job if isinstance(job, str) else getattr(job, 'name', str(job))
+            job = processor.new_job(None, name)
+            job['result']['name'] = name
+        job['data'] = job['image'] = job['output_data'] = None
+        job['result']['success'] = False
+        job['result']['error'] = str(error)
+        if stage_name == 'archive':
+            count_result(job['result'])
+        return job
+
+    def on_discard(job):
+        # Pipeline bị hủy giữa chừng: trả slot scheduler và budget bộ nhớ của job
+        if isinstance(job, dict):
+            release_slot(job)
+            processor.release_memory(job)
+
+    return Pipeline(
+        [
+            Stage('read', read),
+            Stage('decode', decode, workers),
+            Stage('edit', edit),
+            Stage('encode', encode, workers),
+            Stage('archive', write),
+        ],
+        queue_size=queue_size,
+        on_error=on_error,
+        on_discard=on_discard,
+    )
+
+def default_output_path(input_path):
+    # Folder: <folder>_output; file: <tên file>_output cùng cấp với file input
+    if os.path.isdir(input_path):
+        return input_path + "_output"
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(os.path.dirname(input_path), base_name + "_output")
+
+def process_images_in_folder_or_file(input_path, new_device=None, new_date=None, workers=None,
+                                     recursive=None, dry_run=False, incremental=False, output_path=None,
+                                     progress=None, output_format=None):
+    # progress(done, total, result) được gọi mỗi khi một ảnh xử lý xong.
+    # recursive=None: dry-run duyệt cả thư mục con, xử lý thật thì chỉ folder gốc
+    if recursive is None:
+        recursive = dry_run
+    if dry_run:
+        reports = scan_images(input_path, recursive=recursive)
+        for report in reports:
+            status = f"rejected ({report['rejected']})" if report['rejected'] else "error" if report['error'] else "ok"
+            logger.info("%s: %s, %s, gps=%s, date=%s", report['file'], report['format'], status,
+                        report['has_gps'], report['datetime'])
+        logger.info("Scan summary: %s", summarize_scan(reports))
+        return reports
+
+    processor = HeicProcessor(output_format=output_format or OUTPUT_FORMAT)
+
+    if output_path is None:
+        output_path = default_output_path(input_path)
+
+        # Folder output tự sinh: xóa kết quả cũ nếu tồn tại. Folder do người dùng
+        # chỉ định thì không bao giờ bị xóa.
+        if os.path.exists(output_path) and not incremental:
+            shutil.rmtree(output_path)
 
     # Tạo folder output nếu chưa tồn tại
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)  # Xóa folder cũ nếu tồn tại
-    os.makedirs(output_path)
+    os.makedirs(output_path, exist_ok=True)
+    # Lần chạy không incremental ghi đè output mà không cập nhật manifest: xóa
+    # manifest cũ để --resume lần sau không tin vào các bản ghi đã sai
+    if not incremental and os.path.exists(os.path.join(output_path, MANIFEST_NAME)):
+        os.remove(os.path.join(output_path, MANIFEST_NAME))
 
     if os.path.isdir(input_path):
-        image_files = [f for f in os.listdir(input_path) if f.lower().endswith(('.jpg', '.jpeg', '.heic'))]
-        print(f"Found {len(image_files)} images in folder {input_path}")
-
-        for image_file in image_files:
-            image_path = os.path.join(input_path, image_file)
-            success = processor.modify_image_metadata(
-                image_path,
-                output_path,
-                new_device=new_device,
-                new_date=new_date,
-                # day_or_night=day_or_night
-            )
-
-            if success:
-                print(f"Metadata modified successfully for {image_file}")
+        image_paths = find_image_files(input_path, recursive=recursive)
+        logger.info("Found %d images in folder %s", len(image_paths), input_path)
+
+        # Chế độ incremental: bỏ qua ảnh đã có trong manifest với cùng nội dung và tham số
+        results = [None] * len(image_paths)
+        pending = list(range(len(image_paths)))
+        if incremental:
+            manifest = Manifest(output_path)
+            # Thêm các tùy chọn làm thay đổi output khi khác mặc định, để manifest
+            # của các lần chạy trước (chỉ có device/date) vẫn còn hợp lệ
+            params = {'device': new_device, 'date': str(new_date) if new_date else None}
+            options = processor.worker_options()
+            if options['output_format'] != 'jpeg':
+                params['format'] = options['output_format']
+            if options['encoder_preset'] != 'balanced':
+                params['preset'] = options['encoder_preset']
+            if options['low_memory']:
+                params['low_memory'] = True
+            sizes = [os.path.getsize(image_path) for image_path in image_paths]
+            # Chỉ hash ảnh có bản ghi cùng kích thước và tham số; ảnh mới / đã đổi
+            # được hash trong task, từ chính bytes đọc ra để xử lý
+            candidates = [idx for idx, image_path in enumerate(image_paths)
+                          if manifest.is_unchanged(os.path.relpath(image_path, input_path), sizes[idx], params)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                digests = dict(zip(candidates, executor.map(file_digest, [image_paths[idx] for idx in candidates])))
+            pending = []
+            for idx, image_path in enumerate(image_paths):
+                rel_path = os.path.relpath(image_path, input_path)
+                if idx in digests and manifest.is_unchanged(rel_path, sizes[idx], params, digests[idx]):
+                    output_file = os.path.join(output_path, manifest.entries[rel_path]['output'])
+                    results[idx] = {'file': image_path, 'success': True, 'output': output_file,
+                                    'rejected': None, 'error': None, 'skipped': True}
+                else:
+                    pending.append(idx)
+            logger.info("Skipping %d unchanged images", len(image_paths) - len(pending))
+
+        def record_result(task_idx, result):
+            if progress:
+                progress(task_idx + 1, len(pending), result)
+            if incremental and result['success']:
+                idx = pending[task_idx]
+                manifest.record(
+                    os.path.relpath(image_paths[idx], input_path),
+                    sizes[idx],
+                    result['sha256'],
+                    params,
+                    output=os.path.relpath(result['output'], output_path),
+                )
+
+        # Giữ nguyên cấu trúc thư mục con trong folder output
+        tasks = []
+        for idx in pending:
+            image_path = image_paths[idx]
+            image_output_path = os.path.join(output_path, os.path.relpath(os.path.dirname(image_path), input_path))
+            os.makedirs(image_output_path, exist_ok=True)
+            tasks.append((image_path, os.path.normpath(image_output_path), new_device, new_date, incremental))
+        for idx, result in zip(pending, _run_image_tasks(tasks, workers=workers, processor=processor,
+                                                           callback=record_result)):
+            results[idx] = result
+        if incremental:
+            manifest.compact()
+
+        for result in results:
+            image_file = os.path.basename(result['file'])
+            if result.get('skipped'):
+                logger.info("Unchanged, skipped %s", image_file)
+            elif result['success']:
+                logger.info("Metadata modified successfully for %s", image_file)
             else:
-                print(f"Failed to modify metadata for {image_file}")
+                logger.warning("Failed to modify metadata for %s", image_file)
+
+        logger.info("Phase timings: %s", summarize_timings(r.get('timings') or {} for r in results))
+        logger.info("Output written to %s", output_path)
+        return results
     
     elif os.path.isfile(input_path):
-        success = processor.modify_image_metadata(
-            input_path,
-            output_path,
-            new_device=new_device,
-            new_date=new_date,
-            # day_or_night=day_or_night
-        )
+        # Một file: trả về dict kết quả giống từng phần tử của chế độ folder
+        try:
+            result = processor.modify_image_file(input_path, output_path, new_device=new_device, new_date=new_date)
+        except Exception as e:
+            logger.error("Error modifying metadata for %s: %s", input_path, e)
+            result = {'file': input_path, 'success': False, 'output': None, 'rejected': None, 'error': str(e)}
 
-        if success:
-            print(f"Metadata modified successfully for {input_path}")
-            output_file = os.path.join(output_path, f"{base_name}.jpg")
-            return output_file
+        if result['success']:
+            logger.info("Metadata modified successfully for %s", input_path)
         else:
-            print(f"Failed to modify metadata for {input_path}")
+            logger.warning("Failed to modify metadata for %s", input_path)
+        return result
     else:
-        print(f"{input_path} is neither a file nor a folder. Please provide a valid path.")
-    
-    print("+++++++++++++++++++++++++++", output_path)
+        logger.error("%s is neither a file nor a folder. Please provide a valid path.", input_path)
+
     return None
 # def main():
 #     st.title("Image Metadata Modifier 📸")
@@ -341,15 +972,3 @@ def process_images_in_folder_or_file(input_path, new_device=None, new_date=None)
 
 # if __name__ == "__main__":
 #     main()
-def main():
-    input_path = "1107Thao/6-10 images/P12S007/assets/IMG_5560.HEIC"  # Thay thế bằng đường dẫn tới file hoặc folder
-    
-    process_images_in_folder_or_file(
-        input_path,
-        new_device="iPhone 14 Pro Max",
-        new_date="25/12/2023",
-        day_or_night="night"
-    )
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
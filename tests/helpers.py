@@ -0,0 +1,85 @@
+import io
+import struct
+
+import piexif
+import pytest
+from PIL import Image
+
+
+def exif_bytes(orientation=None, model=b"Model A"):
+    exif_dict = {'0th': {piexif.ImageIFD.Model: model, piexif.ImageIFD.DateTime: b"2024:01:02 03:04:05"},
+                 'Exif': {piexif.ExifIFD.DateTimeOriginal: b"2024:01:02 03:04:05"}, 'GPS': {}, '1st': {},
+                 'thumbnail': None}
+    if orientation:
+        exif_dict['0th'][piexif.ImageIFD.Orientation] = orientation
+    return piexif.dump(exif_dict)
+
+
+def make_image(size=(64, 48)):
+    image = Image.new("RGB", size)
+    image.paste((200, 30, 30), (0, 0, size[0] // 2, size[1] // 2))
+    return image
+
+
+def make_jpeg(size=(64, 48), exif=None, **kwargs):
+    buffer = io.BytesIO()
+    if exif is not None:
+        kwargs['exif'] = exif
+    make_image(size).save(buffer, "JPEG", **kwargs)
+    return buffer.getvalue()
+
+
+def make_heic(size=(64, 48), exif=None):
+    pillow_heif = pytest.importorskip("pillow_heif")
+    heif_file = pillow_heif.from_pillow(make_image(size))
+    buffer = io.BytesIO()
+    if exif is not None:
+        heif_file.save(buffer, exif=exif)
+    else:
+        heif_file.save(buffer)
+    return buffer.getvalue()
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def make_heif_container(exif, construction_method=0, extents=1, offset_size=4, last_box_size_zero=False):
+    # HEIF tối giản (ftyp, meta với iinf/iloc, mdat) chỉ chứa item Exif, để thử các
+    # layout iloc mà encoder thật không sinh ra: idat, nhiều extent, field 0 byte...
+    item = b"\0\0\0\0" + exif[len(b"Exif\0\0"):]
+    step = -(-len(item) // extents)
+    chunks = [item[pos:pos + step] for pos in range(0, len(item), step)]
+    version = 1 if construction_method else 0
+    infe = full_box(b'infe', 2, struct.pack(">HH4s", 1, 0, b'Exif') + b"\0")
+    iinf = full_box(b'iinf', 0, struct.pack(">H", 1) + infe)
+
+    def meta(data_start):
+        # offset_size 0: vị trí dữ liệu nằm trong base_offset (4 byte) thay vì trong extent
+        base_offset_size = 0 if offset_size else 4
+        payload = bytes([offset_size << 4 | 4, base_offset_size << 4]) + struct.pack(">HH", 1, 1)
+        if version:
+            payload += struct.pack(">H", construction_method)
+        payload += struct.pack(">H", 0)
+        if base_offset_size:
+            payload += data_start.to_bytes(base_offset_size, 'big')
+            data_start = 0
+        payload += struct.pack(">H", len(chunks))
+        for chunk in chunks:
+            payload += data_start.to_bytes(offset_size, 'big') + len(chunk).to_bytes(4, 'big')
+            data_start += len(chunk)
+        children = iinf + full_box(b'iloc', version, payload)
+        if construction_method == 1:
+            children += box(b'idat', item)
+        return full_box(b'meta', 0, children)
+
+    ftyp = box(b'ftyp', b'heic\0\0\0\0mif1heic')
+    if construction_method == 1:
+        return ftyp + meta(0)
+    data_start = len(ftyp) + len(meta(0)) + 8
+    mdat = struct.pack(">I4s", 0 if last_box_size_zero else 8 + len(item), b'mdat') + item
+    return ftyp + meta(data_start) + mdat
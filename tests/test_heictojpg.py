@@ -0,0 +1,71 @@
+import threading
+import time
+
+import piexif
+import pytest
+
+import heictojpg
+from modules.decoder import probe
+from modules.geocache import GeocodeCache
+from tests.helpers import make_heic
+
+
+class FakeBackend:
+    # Ghi lại thời điểm và thread của từng request thay vì gọi Nominatim
+    def __init__(self):
+        self.calls = []
+
+    def reverse(self, latitude, longitude, language):
+        self.calls.append((time.monotonic(), threading.current_thread().name))
+        return {'address': f"{latitude:.1f}, Area, City, Country", 'raw': {}}
+
+
+def gps_exif(latitude):
+    gps = {
+        piexif.GPSIFD.GPSLatitudeRef: b"N",
+        piexif.GPSIFD.GPSLatitude: ((latitude, 1), (0, 1), (0, 1)),
+        piexif.GPSIFD.GPSLongitudeRef: b"E",
+        piexif.GPSIFD.GPSLongitude: ((106, 1), (0, 1), (0, 1)),
+    }
+    return piexif.dump({'0th': {piexif.ImageIFD.Model: b"Model A"}, 'Exif': {}, 'GPS': gps, '1st': {},
+                        'thumbnail': None})
+
+
+@pytest.fixture
+def processor():
+    processor = heictojpg.HeicProcessor(geocode_backend=FakeBackend())
+    processor.geocode_queue.cache = GeocodeCache(":memory:")
+    processor.geocode_queue.rate = 20
+    yield processor
+    processor.geocode_queue.close()
+
+
+def test_sync_and_queued_lookups_share_one_rate_limit(processor):
+    backend = processor.geocode_queue.backend
+    future = processor.submit_gps_lookup(piexif.load(gps_exif(10)))
+    for latitude in (11, 12, 13):
+        assert processor.reverse_geocode(latitude, 106).startswith(f"{latitude}.0")
+    future.result()
+
+    starts = sorted(start for start, _ in backend.calls)
+    assert len(starts) == 4
+    assert all(b - a >= 1 / 20 - 0.01 for a, b in zip(starts, starts[1:]))
+    assert threading.current_thread().name not in {name for _, name in backend.calls}
+
+
+def test_batch_prefetch_does_not_read_whole_files(processor, tmp_path, monkeypatch):
+    jobs = []
+    for idx in range(2):
+        path = tmp_path / f"{idx}.heic"
+        path.write_bytes(make_heic(exif=gps_exif(10 + idx)))
+        jobs.append((str(path), str(tmp_path / f"{idx}.jpg")))
+    probed = []
+    monkeypatch.setattr(heictojpg, 'probe', lambda data, is_heic: probed.append(len(data)) or probe(data, is_heic))
+
+    results = processor.convert_heic_batch(jobs)
+
+    # Mỗi file chỉ được probe một lần, trong convert_heic_to_jpg
+    assert len(probed) == 2
+    assert [result['address'][0] for result in results] == ["10.0", "11.0"]
+    assert len(processor.geocode_queue.backend.calls) == 2
+
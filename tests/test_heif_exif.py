@@ -0,0 +1,102 @@
+import piexif
+import pytest
+
+from modules.heif_exif import find_replaceable_exif_item, read_heif_exif, read_heif_exif_from_file, replace_heif_exif
+from tests.helpers import box, exif_bytes, make_heic, make_heif_container
+
+pillow_heif = pytest.importorskip("pillow_heif")
+
+SHORTER = exif_bytes(model=b"B")
+LONGER = exif_bytes(model=b"x" * 500)
+
+
+def changed_offsets(before, after):
+    return {pos for pos, (a, b) in enumerate(zip(before, after)) if a != b}
+
+
+def pixels(data):
+    return pillow_heif.open_heif(data).to_pillow().tobytes()
+
+
+def test_in_place_rewrite_only_touches_exif_extent():
+    data = make_heic((128, 96), exif=exif_bytes(orientation=6))
+    location = find_replaceable_exif_item(data)
+    start = location['base_offset'] + location['extents'][0][0]
+    length_pos = location['extent_fields'][0][1]
+
+    output = replace_heif_exif(data, SHORTER)
+
+    assert len(output) == len(data)
+    allowed = set(range(start, start + location['extents'][0][1]))
+    allowed |= set(range(length_pos, length_pos + location['length_size']))
+    assert changed_offsets(data, output) <= allowed
+    assert read_heif_exif(output) == SHORTER
+    assert pillow_heif.open_heif(output).info['exif'] == SHORTER
+    assert pixels(output) == pixels(data)
+
+
+def test_grown_exif_moves_to_new_mdat():
+    data = make_heic((128, 96), exif=exif_bytes(orientation=6))
+    location = find_replaceable_exif_item(data)
+    offset_pos, length_pos = location['extent_fields'][0]
+
+    output = replace_heif_exif(data, LONGER)
+
+    # Dữ liệu cũ giữ nguyên từng byte trừ hai field offset/length của extent
+    allowed = set(range(offset_pos, offset_pos + location['offset_size']))
+    allowed |= set(range(length_pos, length_pos + location['length_size']))
+    assert changed_offsets(data, output[:len(data)]) <= allowed
+    assert output[len(data) + 4:len(data) + 8] == b'mdat'
+    assert read_heif_exif(output) == LONGER
+    assert piexif.load(pillow_heif.open_heif(output).info['exif'])['0th'][piexif.ImageIFD.Model] == b"x" * 500
+    assert pixels(output) == pixels(data)
+
+
+def test_read_from_file_matches_in_memory(tmp_path):
+    path = tmp_path / "a.heic"
+    path.write_bytes(replace_heif_exif(make_heic(exif=exif_bytes()), LONGER))
+    assert read_heif_exif_from_file(str(path)) == LONGER
+    path.write_bytes(make_heic())
+    assert read_heif_exif_from_file(str(path)) is None
+
+
+@pytest.mark.parametrize('layout', [{}, {'construction_method': 1}, {'extents': 3}, {'offset_size': 0}])
+def test_read_supported_layouts(layout, tmp_path):
+    data = make_heif_container(exif_bytes(), **layout)
+    path = tmp_path / "a.heic"
+    path.write_bytes(data)
+    assert read_heif_exif(data) == exif_bytes()
+    assert read_heif_exif_from_file(str(path)) == exif_bytes()
+
+
+@pytest.mark.parametrize('layout', [{}, {'offset_size': 0}, {'last_box_size_zero': True}])
+def test_in_place_rewrite_of_synthetic_layouts(layout):
+    output = replace_heif_exif(make_heif_container(exif_bytes(), **layout), SHORTER)
+    assert read_heif_exif(output) == SHORTER
+
+
+def test_grown_rewrite_of_synthetic_container():
+    output = replace_heif_exif(make_heif_container(exif_bytes()), LONGER)
+    assert read_heif_exif(output) == LONGER
+
+
+@pytest.mark.parametrize('data, message', [
+    (box(b'ftyp', b'heic\0\0\0\0mif1heic') + box(b'mdat', b''), "No meta box"),
+    (make_heic(), "no Exif item"),
+    (make_heif_container(exif_bytes(), construction_method=1), "Unsupported Exif item layout"),
+    (make_heif_container(exif_bytes(), extents=3), "Unsupported Exif item layout"),
+], ids=['no-meta', 'no-exif-item', 'idat', 'multi-extent'])
+def test_unsupported_files_raise(data, message):
+    with pytest.raises(ValueError, match=message):
+        find_replaceable_exif_item(data)
+    with pytest.raises(ValueError, match=message):
+        replace_heif_exif(data, SHORTER)
+
+
+@pytest.mark.parametrize('layout, message', [
+    ({'last_box_size_zero': True}, "Last box extends to end of file"),
+    ({'offset_size': 0}, "does not fit the iloc field"),
+])
+def test_grown_exif_without_room_raises(layout, message):
+    with pytest.raises(ValueError, match=message):
+        replace_heif_exif(make_heif_container(exif_bytes(), **layout), LONGER)
@@ -0,0 +1,102 @@
+import io
+
+import piexif
+import pytest
+from PIL import Image
+
+from modules.jpeg_exif import (APP0, APP1, EXIF_HEADER, SOS, iter_segments, read_exif_from_file, read_exif_segment,
+                               replace_exif_segment)
+from tests.helpers import exif_bytes, make_jpeg
+
+NEW_EXIF = exif_bytes(model=b"Model B")
+
+
+def markers(data):
+    return [marker for marker, _, _ in iter_segments(data)]
+
+
+def scan_data(data):
+    # Dữ liệu ảnh nén: từ marker SOS tới hết file
+    for marker, start, _ in iter_segments(data):
+        if marker == SOS:
+            return data[start:]
+    raise AssertionError("no SOS marker")
+
+
+def strip_app0(data):
+    for marker, start, end in iter_segments(data):
+        if marker == APP0:
+            return data[:start] + data[end:]
+    return data
+
+
+def assert_round_trip(data, output, tmp_path):
+    assert scan_data(output) == scan_data(data)
+    assert read_exif_segment(output) == NEW_EXIF
+    path = tmp_path / "out.jpg"
+    path.write_bytes(output)
+    assert read_exif_from_file(str(path)) == NEW_EXIF
+    image = Image.open(io.BytesIO(output))
+    image.load()
+    assert piexif.load(image.info['exif'])['0th'][piexif.ImageIFD.Model] == b"Model B"
+    assert image.tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+
+def test_replace_existing_exif(tmp_path):
+    data = make_jpeg(exif=exif_bytes(orientation=6))
+    output = replace_exif_segment(data, NEW_EXIF)
+    assert markers(output) == markers(data)
+    assert_round_trip(data, output, tmp_path)
+
+
+def test_insert_after_jfif_app0(tmp_path):
+    data = make_jpeg()
+    assert read_exif_segment(data) is None
+    output = replace_exif_segment(data, NEW_EXIF)
+    assert markers(output)[:2] == [APP0, APP1]
+    assert_round_trip(data, output, tmp_path)
+
+
+def test_insert_after_soi_without_app0(tmp_path):
+    data = strip_app0(make_jpeg())
+    output = replace_exif_segment(data, NEW_EXIF)
+    assert markers(output)[0] == APP1
+    assert_round_trip(data, output, tmp_path)
+
+
+def test_fill_bytes_before_marker(tmp_path):
+    data = make_jpeg(exif=exif_bytes())
+    # Chèn hai byte fill 0xFF trước marker thứ hai (hợp lệ theo chuẩn JPEG)
+    second = list(iter_segments(data))[1][1]
+    data = data[:second] + b"\xff\xff" + data[second:]
+    assert read_exif_segment(data) == exif_bytes()
+    path = tmp_path / "in.jpg"
+    path.write_bytes(data)
+    assert read_exif_from_file(str(path)) == exif_bytes()
+    assert_round_trip(data, replace_exif_segment(data, NEW_EXIF), tmp_path)
+
+
+def test_exif_without_header_is_prefixed():
+    output = replace_exif_segment(make_jpeg(), NEW_EXIF[len(EXIF_HEADER):])
+    assert read_exif_segment(output) == NEW_EXIF
+
+
+def test_read_from_file_without_exif(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(make_jpeg())
+    assert read_exif_from_file(str(path)) is None
+
+
+def test_exif_too_big_raises():
+    with pytest.raises(ValueError, match="too big"):
+        replace_exif_segment(make_jpeg(exif=exif_bytes()), EXIF_HEADER + b"\0" * 0xFFFF)
+
+
+@pytest.mark.parametrize('data', [b"GIF89a", b"\xff\xd8\x00\x00"], ids=['not-jpeg', 'bad-marker'])
+def test_invalid_jpeg_raises(data, tmp_path):
+    with pytest.raises(ValueError):
+        replace_exif_segment(data, NEW_EXIF)
+    path = tmp_path / "a.jpg"
+    path.write_bytes(data)
+    with pytest.raises(ValueError):
+        read_exif_from_file(str(path))
@@ -0,0 +1,101 @@
+import os
+import threading
+
+import piexif
+
+from modules import processor as processor_module
+from modules.heif_exif import read_heif_exif
+from modules.manifest import Manifest, file_digest
+from modules.memory import MemoryBudget
+from modules.processor import FairScheduler, HeicProcessor, build_image_pipeline, process_images_in_folder_or_file
+from tests.helpers import exif_bytes, make_heic, make_jpeg
+
+
+def run_pipeline(pipeline, items, timeout=30):
+    # Chạy pipeline ở thread riêng để test báo lỗi thay vì treo khi pipeline deadlock
+    results = []
+    consumer = threading.Thread(target=lambda: results.extend(pipeline.run(items)), daemon=True)
+    consumer.start()
+    consumer.join(timeout)
+    assert not consumer.is_alive(), "pipeline did not finish"
+    return results
+
+
+class OrderedProcessor(HeicProcessor):
+    # Giữ HEIC ở bước edit tới khi r1.jpg (decode sau nó) đã lấy được budget, để
+    # encode luôn gặp đúng thứ tự gây treo thay vì phụ thuộc thread nào chạy trước
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.r1_reserved = threading.Event()
+
+    def reserve_memory(self, job, nbytes, **kwargs):
+        super().reserve_memory(job, nbytes, **kwargs)
+        if job['name'] == 'r1.jpg':
+            self.r1_reserved.set()
+
+    def edit_image(self, job, **kwargs):
+        if job['is_heic']:
+            self.r1_reserved.wait(1)
+        return super().edit_image(job, **kwargs)
+
+
+def test_transcode_fallback_does_not_wait_for_memory():
+    # HEIC chưa có item Exif ở chế độ giữ HEIC phải transcode. Nếu bộ nhớ cho việc
+    # đó được chờ ở bước encode thì ảnh JPEG xoay decode sau nó giữ hết budget,
+    # còn encode (nơi duy nhất giải phóng budget) lại đang chờ: pipeline treo.
+    budget = MemoryBudget(limit_mb=20)
+    scheduler = FairScheduler(slots=4, memory_budget=budget)
+    processor = OrderedProcessor(memory_budget=budget, output_format='heic')
+    pipeline = build_image_pipeline(processor, workers=1, output_format='heic', scheduler=scheduler)
+
+    rotated = make_jpeg((2000, 2000), exif=exif_bytes(orientation=6))
+    items = [('r0.jpg', rotated), ('noexif.heic', make_heic()), ('r1.jpg', rotated), ('r2.jpg', rotated)]
+    jobs = run_pipeline(pipeline, items)
+
+    results = {job['result']['file']: job['result'] for job in jobs}
+    assert all(result['success'] for result in results.values())
+    assert results['noexif.heic']['output'] == 'noexif.jpg'
+    assert budget.used == 0
+    assert scheduler.stats()['busy'] == 0
+
+
+def test_keep_heic_rewrites_exif_item():
+    data = make_heic(exif=exif_bytes(orientation=6))
+    output, result = HeicProcessor(output_format='heic').modify_image_bytes(data, 'a.heic', new_device="Model B")
+
+    assert result['success'] and result['output'] == 'a.heic'
+    exif_dict = piexif.load(read_heif_exif(output))
+    assert exif_dict['0th'][piexif.ImageIFD.Model] == b"Model B"
+    assert exif_dict['0th'][piexif.ImageIFD.Orientation] == 6
+
+
+def test_resume_hashes_only_files_that_may_be_unchanged(tmp_path, monkeypatch):
+    input_path = tmp_path / "in"
+    output_path = tmp_path / "out"
+    input_path.mkdir()
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        (input_path / name).write_bytes(make_jpeg(exif=exif_bytes()))
+    hashed = []
+    monkeypatch.setattr(processor_module, 'file_digest', lambda path: hashed.append(path) or file_digest(path))
+
+    def run():
+        hashed.clear()
+        return process_images_in_folder_or_file(str(input_path), new_device="Model B", workers=1,
+                                                incremental=True, output_path=str(output_path))
+
+    # Lần đầu: chưa có manifest, hash trong task từ bytes đã đọc
+    results = run()
+    assert hashed == [] and all(result['success'] for result in results)
+    manifest = Manifest(str(output_path))
+    assert manifest.entries['a.jpg']['sha256'] == file_digest(str(input_path / "a.jpg"))
+
+    # Không đổi gì: mọi ảnh được hash để so và được bỏ qua
+    assert all(result.get('skipped') for result in run())
+    assert len(hashed) == 3
+
+    # a.jpg đổi kích thước: bỏ qua bước hash trước, xử lý lại
+    (input_path / "a.jpg").write_bytes(make_jpeg((80, 60), exif=exif_bytes()))
+    results = run()
+    assert sorted(os.path.basename(path) for path in hashed) == ["b.jpg", "c.jpg"]
+    assert not results[0].get('skipped') and results[0]['success']
+    assert Manifest(str(output_path)).entries['a.jpg']['sha256'] == file_digest(str(input_path / "a.jpg"))